@@ -4,6 +4,7 @@ from typing import Tuple, List
 import itertools as iter
 from utils import bitstring_to_int, convert_to_clicks, total_variation_distance
 from itertools import combinations
+from marginal_table import MarginalTable
 from strawberryfields import ops
 from greedy import Greedy
 from scipy.stats import unitary_group
@@ -93,20 +94,19 @@ class BS_simulation:
         n_input_photons: int,
         unitary: np.ndarray,
         k_order: int
-    ) -> np.ndarray:
+    ) -> MarginalTable:
         """Gets ground truth k-th order marginals from the output statevector of the Strawberry
         Fields simulation of a BS experiment with the given number of modes, squeezing
         parameters and unitary matrix (defining the interferometer). The fock cutoff defines
-        the truncation of the fock basis in the simulation. Returns an array where each element
-        has two sublists. The first one is the set of mode indices of that marginal, and the 
-        second one is the marginal distribution. The number of input photons parameter specifies
+        the truncation of the fock basis in the simulation. Returns a MarginalTable
+        with the mode indices of every marginal and its distribution. The number of input photons parameter specifies
         how many input modes have a single photon (the rest are initialised as vacuum)."""
         comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
         marginals : List = []
         for modes in comb:
             marg = self.get_ideal_BS_marginal_from_fock_simulation(n_modes, fock_cutoff, n_input_photons, unitary, modes)
             marginals.append([modes, marg])
-        return np.array(marginals)
+        return MarginalTable.from_pairs(marginals)
     
 
 bs = BS_simulation()
@@ -0,0 +1,280 @@
+from typing import Dict, Iterator, List, Union
+import numpy as np
+import json
+from utils import write_file_atomically
+
+# Number of 1s in the binary representation of every possible byte.
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class ClickMatrix():
+    """Bit-packed matrix of threshold detection patterns (e.g. the S matrix of the
+    greedy algorithm). Every row is stored in ceil(n_modes/8) bytes, with the first
+    mode in the most significant bit of the first byte, so that the row codes match
+    the decimal representation of bitstrings used everywhere else (bitstring_to_int)."""
+
+    def __init__(self, packed: np.ndarray, n_modes: int):
+        self.packed = np.asarray(packed, dtype=np.uint8)
+        self.n_modes = n_modes
+        if self.packed.ndim != 2 or self.packed.shape[1] != -(-n_modes // 8):
+            raise ValueError('packed must have shape (n_rows, ceil(n_modes/8))')
+
+    @classmethod
+    def from_dense(cls, S_matrix: np.ndarray) -> 'ClickMatrix':
+        """Packs a matrix of 0s and 1s with one row per detection pattern."""
+        S_matrix = np.asarray(S_matrix)
+        return cls(np.packbits(S_matrix != 0, axis=1), S_matrix.shape[1])
+
+    @classmethod
+    def from_row_codes(cls, row_codes: np.ndarray, n_modes: int) -> 'ClickMatrix':
+        """Packs the detection patterns given as integers (n_modes <= 64)."""
+        if n_modes > 64:
+            raise ValueError('Row codes are only defined for up to 64 modes')
+        n_bytes = -(-n_modes // 8)
+        shifted = np.asarray(row_codes, dtype=np.uint64) << np.uint64(8*n_bytes - n_modes)
+        big_endian = shifted.astype('>u8').view(np.uint8).reshape(-1, 8)
+        return cls(big_endian[:, 8 - n_bytes:], n_modes)
+
+    @property
+    def shape(self):
+        return (len(self.packed), self.n_modes)
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def to_dense(self) -> np.ndarray:
+        """Returns the unpacked matrix of 0s and 1s (as uint8)."""
+        return np.unpackbits(self.packed, axis=1, count=self.n_modes)
+
+    def get_row_codes(self) -> np.ndarray:
+        """Returns every row as an integer (uint64), i.e. the decimal representation
+        of the detection pattern. Only available for up to 64 modes."""
+        if self.n_modes > 64:
+            raise ValueError('Row codes are only defined for up to 64 modes')
+        n_bytes = self.packed.shape[1]
+        padded = np.zeros((len(self.packed), 8), dtype=np.uint8)
+        padded[:, 8 - n_bytes:] = self.packed
+        codes = padded.view('>u8')[:, 0].astype(np.uint64)
+        return codes >> np.uint64(8*n_bytes - self.n_modes)
+
+    def get_popcounts(self) -> np.ndarray:
+        """Returns the number of clicks in every row."""
+        return np.sum(POPCOUNT_TABLE[self.packed], axis=1, dtype=np.int64)
+
+    def get_columns(self, columns: Union[int, List]) -> np.ndarray:
+        """Returns the unpacked columns (modes) with the given indices, as a
+        (n_rows, len(columns)) array of 0s and 1s."""
+        columns = np.atleast_1d(columns)
+        shifts = (7 - columns % 8).astype(np.uint8)
+        return (self.packed[:, columns // 8] >> shifts) & np.uint8(1)
+
+    def take(self, rows: np.ndarray) -> 'ClickMatrix':
+        """Returns the rows with the given indices (or boolean mask)."""
+        return ClickMatrix(self.packed[rows], self.n_modes)
+
+    def get_rows_with_n_clicks(self, n: int) -> 'ClickMatrix':
+        """Returns the rows with exactly n clicks."""
+        return self.take(self.get_popcounts() == n)
+
+    def get_distribution(self) -> np.ndarray:
+        """Returns the empirical distribution over all 2^n_modes detection patterns."""
+        counts = np.bincount(self.get_row_codes().astype(np.int64), minlength=2**self.n_modes)
+        return counts / np.sum(counts)
+
+
+class SparseClickMatrix():
+    """Matrix of threshold detection patterns stored as click lists, in the CSR
+    format of scipy.sparse: the modes which click in row i are indices[indptr[i]:
+    indptr[i+1]], in increasing order. In the low photon number regime most rows
+    have no clicks or a single one, so the memory used and the time taken to scan
+    the matrix scale with the number of clicks instead of n_rows*n_modes. It has
+    the same interface as ClickMatrix."""
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, n_modes: int):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.n_modes = n_modes
+        if self.indptr.ndim != 1 or len(self.indptr) == 0 or self.indptr[-1] != len(self.indices):
+            raise ValueError('indptr must have n_rows + 1 entries, the last being the number of clicks')
+
+    @classmethod
+    def from_dense(cls, S_matrix: np.ndarray) -> 'SparseClickMatrix':
+        """Builds the click lists of a matrix of 0s and 1s with one row per detection pattern."""
+        S_matrix = np.asarray(S_matrix)
+        rows, modes = np.nonzero(S_matrix)
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(S_matrix)))))
+        return cls(indptr, modes, S_matrix.shape[1])
+
+    @classmethod
+    def from_click_matrix(cls, click_matrix: ClickMatrix) -> 'SparseClickMatrix':
+        """Builds the click lists of a bit-packed ClickMatrix, one byte column at a time."""
+        rows_list, modes_list = [], []
+        for byte in range(click_matrix.packed.shape[1]):
+            column = click_matrix.packed[:, byte]
+            nonzero = np.flatnonzero(column)
+            bits = np.unpackbits(column[nonzero].reshape(-1, 1), axis=1)
+            rows, positions = np.nonzero(bits)
+            rows_list.append(nonzero[rows])
+            modes_list.append(8*byte + positions)
+        rows = np.concatenate(rows_list)
+        modes = np.concatenate(modes_list)
+        order = np.lexsort((modes, rows))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(click_matrix)))))
+        return cls(indptr, modes[order], click_matrix.n_modes)
+
+    @property
+    def shape(self):
+        return (len(self.indptr) - 1, self.n_modes)
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def get_click_rows(self) -> np.ndarray:
+        """Returns the row of every click, aligned with indices."""
+        return np.repeat(np.arange(len(self)), self.get_popcounts())
+
+    def to_dense(self) -> np.ndarray:
+        """Returns the matrix of 0s and 1s (as uint8)."""
+        S_matrix = np.zeros(self.shape, dtype=np.uint8)
+        S_matrix[self.get_click_rows(), self.indices] = 1
+        return S_matrix
+
+    def to_click_matrix(self) -> ClickMatrix:
+        """Returns the bit-packed version of the matrix."""
+        packed = np.zeros((len(self), -(-self.n_modes // 8)), dtype=np.uint8)
+        bits = (np.uint8(128) >> (self.indices % 8).astype(np.uint8))
+        np.bitwise_or.at(packed, (self.get_click_rows(), self.indices // 8), bits)
+        return ClickMatrix(packed, self.n_modes)
+
+    def get_row_codes(self) -> np.ndarray:
+        """Returns every row as an integer (uint64), i.e. the decimal representation
+        of the detection pattern. Only available for up to 64 modes."""
+        if self.n_modes > 64:
+            raise ValueError('Row codes are only defined for up to 64 modes')
+        codes = np.zeros(len(self), dtype=np.uint64)
+        bits = np.uint64(1) << (self.n_modes - 1 - self.indices).astype(np.uint64)
+        np.bitwise_or.at(codes, self.get_click_rows(), bits)
+        return codes
+
+    def get_popcounts(self) -> np.ndarray:
+        """Returns the number of clicks in every row."""
+        return np.diff(self.indptr)
+
+    def get_columns(self, columns: Union[int, List]) -> np.ndarray:
+        """Returns the unpacked columns (modes) with the given indices, as a
+        (n_rows, len(columns)) array of 0s and 1s."""
+        columns = np.atleast_1d(columns)
+        lookup = np.full(self.n_modes, -1, dtype=np.int64)
+        lookup[columns] = np.arange(len(columns))
+        positions = lookup[self.indices]
+        selected = positions >= 0
+        result = np.zeros((len(self), len(columns)), dtype=np.uint8)
+        result[self.get_click_rows()[selected], positions[selected]] = 1
+        return result
+
+    def take(self, rows: np.ndarray) -> 'SparseClickMatrix':
+        """Returns the rows with the given indices (or boolean mask)."""
+        rows = np.arange(len(self))[rows]
+        popcounts = self.get_popcounts()[rows]
+        indptr = np.concatenate(([0], np.cumsum(popcounts)))
+        offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1], popcounts)
+        indices = self.indices[np.repeat(self.indptr[rows], popcounts) + offsets]
+        return SparseClickMatrix(indptr, indices, self.n_modes)
+
+    def get_rows_with_n_clicks(self, n: int) -> 'SparseClickMatrix':
+        """Returns the rows with exactly n clicks."""
+        return self.take(self.get_popcounts() == n)
+
+    def get_distribution(self) -> np.ndarray:
+        """Returns the empirical distribution over all 2^n_modes detection patterns."""
+        counts = np.bincount(self.get_row_codes().astype(np.int64), minlength=2**self.n_modes)
+        return counts / np.sum(counts)
+
+
+class ClickMatrixStore():
+    """Bit-packed matrix of detection patterns kept on disk, for S matrices which do
+    not fit in memory. The packed rows (as in ClickMatrix) are stored in a .npy file
+    which is memory-mapped, and the metadata in a JSON file next to it (path +
+    '.json'): the number of modes, the capacity and the list of chunks written so
+    far, each with its first and last row, its number of clicks and any other
+    values given when it was appended (e.g. the marginal distances of the greedy
+    matrix so far, see Greedy.get_S_matrix_store).
+
+    Only the rows of the chunks written so far belong to the matrix, and they are
+    read one chunk at a time (see iter_chunks), so its analytics hold only one
+    chunk in memory."""
+
+    def __init__(self, path: str, mode: str = 'r'):
+        self.path = path
+        with open(path + '.json') as f:
+            self.metadata: Dict = json.load(f)
+        self.n_modes = self.metadata['n_modes']
+        self.packed = np.load(path, mmap_mode=mode)
+
+    @classmethod
+    def create(cls, path: str, n_rows: int, n_modes: int) -> 'ClickMatrixStore':
+        """Creates an empty store at path with room for n_rows rows. An existing
+        store at path is overwritten."""
+        packed = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(n_rows, -(-n_modes // 8)))
+        del packed
+        store_metadata = {'n_modes': n_modes, 'capacity': n_rows, 'chunks': []}
+        cls._write_metadata(path, store_metadata)
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def _write_metadata(path: str, metadata: Dict) -> None:
+        """Writes the metadata of the store at path (see write_file_atomically)."""
+        write_file_atomically(path + '.json', lambda f: json.dump(metadata, f), mode='w')
+
+    @property
+    def chunks(self) -> List[Dict]:
+        return self.metadata['chunks']
+
+    @property
+    def shape(self):
+        return (len(self), self.n_modes)
+
+    def __len__(self) -> int:
+        return self.chunks[-1]['stop'] if self.chunks else 0
+
+    def append(self, chunk: Union[np.ndarray, ClickMatrix], **chunk_metadata) -> None:
+        """Writes the rows of chunk (dense or packed) after the rows already in the
+        store and records them as a new chunk. The rows are flushed to disk before
+        the metadata, so the metadata only lists chunks which are complete."""
+        if not isinstance(chunk, ClickMatrix):
+            chunk = ClickMatrix.from_dense(chunk)
+        if chunk.n_modes != self.n_modes:
+            raise ValueError('The chunk has a different number of modes than the store')
+        start = len(self)
+        stop = start + len(chunk)
+        if stop > self.metadata['capacity']:
+            raise ValueError(f'The store has room for {self.metadata["capacity"]} rows')
+        self.packed[start:stop] = chunk.packed
+        self.packed.flush()
+        record = {'start': start, 'stop': stop, 'n_clicks': int(np.sum(chunk.get_popcounts()))}
+        record.update(chunk_metadata)
+        self.chunks.append(record)
+        self._write_metadata(self.path, self.metadata)
+
+    def get_chunk(self, i: int) -> ClickMatrix:
+        """Returns the i-th chunk, read into memory."""
+        return ClickMatrix(np.array(self.packed[self.chunks[i]['start']:self.chunks[i]['stop']]), self.n_modes)
+
+    def iter_chunks(self) -> Iterator[ClickMatrix]:
+        """Yields the chunks in order, reading one at a time into memory."""
+        return (self.get_chunk(i) for i in range(len(self.chunks)))
+
+    def get_click_number_distribution(self) -> np.ndarray:
+        """Returns the fraction of rows with 0, 1, ..., n_modes clicks."""
+        counts = np.zeros(self.n_modes + 1)
+        for chunk in self.iter_chunks():
+            counts += np.bincount(chunk.get_popcounts(), minlength=self.n_modes + 1)
+        return counts / np.sum(counts)
+
+    def get_distribution(self) -> np.ndarray:
+        """Returns the empirical distribution over all 2^n_modes detection patterns,
+        counted one chunk at a time."""
+        counts = np.zeros(2**self.n_modes)
+        for chunk in self.iter_chunks():
+            counts += np.bincount(chunk.get_row_codes().astype(np.int64), minlength=2**self.n_modes)
+        return counts / np.sum(counts)
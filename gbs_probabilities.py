@@ -1,15 +1,155 @@
-from typing import List, Tuple
+from typing import List, Tuple, Union
 import numpy as np
-import copy 
 from thewalrus import tor, hafnian
 from utils import get_click_indices, get_binary_basis
 import strawberryfields as sf
 import thewalrus
 from itertools import combinations
+from collections import OrderedDict
+from marginal_table import MarginalTable
 from gbs_circuits import get_ideal_gbs_circuit, get_gbs_circuit_with_optical_loss
 
 
+class LRUCache:
+    """Dictionary with at most max_size entries, which evicts the least recently used
+    entry when it is full. The lookups which find (hits) and do not find (misses)
+    their key are counted."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value of key, or None if it is not in the cache."""
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value) -> None:
+        """Adds the value of key, evicting the least recently used entry if needed."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class GBSState:
+    """Quantities of the output state of a GBS experiment which are shared by all of
+    its marginals, computed once per (unitary, squeezing parameters, loss): the
+    covariance matrix of the n_modes output modes (in xxpp ordering, hbar = 2), its
+    Q matrix (thewalrus.quantum.Qmat) and, for every set of modes that has been
+    asked for, the inverse and the log-determinant of the reduced Q matrix. Any
+    extra (e.g. loss) modes of the covariance matrix after the first n_modes are
+    traced out.
+
+    The probabilities of no clicks in subsets of modes are kept in vacuum_cache,
+    shared by all the marginals of the state, so marginals which overlap (e.g. [0,1],
+    [0,2] and [1,2]) only compute the determinant of each subset once: all the k = 2
+    marginals need n + C(n,2) determinants. The reduced inverses are kept in
+    inverse_cache. Both caches hold at most cache_size entries (see LRUCache)."""
+
+    def __init__(self, cov_matrix: np.ndarray, n_modes: Union[int, None] = None, cache_size: int = 2**20):
+        n_all_modes = len(cov_matrix) // 2
+        if n_modes is None:
+            n_modes = n_all_modes
+        self.n_modes = n_modes
+        inds = np.concatenate((np.arange(n_modes), n_all_modes + np.arange(n_modes)))
+        self.cov_matrix = cov_matrix[np.ix_(inds, inds)]
+        self.Q_matrix = thewalrus.quantum.Qmat(self.cov_matrix)
+        self.vacuum_cache = LRUCache(cache_size)
+        self.inverse_cache = LRUCache(cache_size)
+
+    def get_reduced_Q_matrix(self, modes: List) -> np.ndarray:
+        """Returns the rows and columns of the Q matrix of the given modes (and of
+        their conjugates), as in TheoreticalProbabilities.get_reduced_matrix."""
+        inds = np.concatenate((modes, np.asarray(modes) + self.n_modes)).astype(int)
+        return self.Q_matrix[np.ix_(inds, inds)]
+
+    def get_reduced_inverse_and_logdet(self, modes: List) -> Tuple[np.ndarray, float]:
+        """Returns the inverse and the log-determinant of the reduced Q matrix of the
+        given modes, which are computed the first time they are asked for."""
+        key = tuple(int(m) for m in modes)
+        inverse_and_logdet = self.inverse_cache.get(key)
+        if inverse_and_logdet is None:
+            reduced_Q = self.get_reduced_Q_matrix(list(key))
+            _, logdet = np.linalg.slogdet(reduced_Q)
+            inverse_and_logdet = (np.linalg.inv(reduced_Q), float(logdet))
+            self.inverse_cache.put(key, inverse_and_logdet)
+        return inverse_and_logdet
+
+    def get_vacuum_probabilities(self, modes: List) -> np.ndarray:
+        """Returns the probability of no clicks in every subset B of the given k modes,
+        1/sqrt(det(Q_B)), as an array of length 2^k indexed by the subsets in decimal
+        (the first mode being the most significant bit)."""
+        return self.get_vacuum_probabilities_batch(np.array([modes]))[0]
+
+    def get_vacuum_probabilities_batch(self, modes: np.ndarray) -> np.ndarray:
+        """Batched version of get_vacuum_probabilities for a (B, k) array of mode sets,
+        which returns a (B, 2^k) array. The distinct subsets of all the mode sets which
+        are not in vacuum_cache are gathered into one (N, 2m, 2m) stack of reduced Q
+        matrices per subset size m, whose log-determinants are evaluated with a single
+        np.linalg.slogdet call."""
+        modes = np.asarray(modes, dtype=int)
+        n_sets, k_order = modes.shape
+        subsets = np.arange(2**k_order)
+        bits = (subsets.reshape(-1, 1) >> np.arange(k_order - 1, -1, -1)) & 1
+        sizes = np.sum(bits, axis=1)
+        probabilities = np.ones((n_sets, 2**k_order))
+        for size in range(1, k_order + 1):
+            selected = subsets[sizes == size]
+            positions = np.nonzero(bits[selected])[1].reshape(-1, size)
+            subset_modes = np.sort(modes[:, positions], axis=-1).reshape(-1, size)
+            unique_modes, inverse = np.unique(subset_modes, axis=0, return_inverse=True)
+            keys = [tuple(m) for m in unique_modes.tolist()]
+            values = np.empty(len(unique_modes))
+            missing = []
+            for i, key in enumerate(keys):
+                cached = self.vacuum_cache.get(key)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    values[i] = cached
+            if missing:
+                missing_modes = unique_modes[missing]
+                inds = np.concatenate((missing_modes, missing_modes + self.n_modes), axis=1)
+                _, logdets = np.linalg.slogdet(self.Q_matrix[inds[:, :, np.newaxis], inds[:, np.newaxis, :]])
+                values[missing] = np.exp(-0.5 * logdets)
+                for i in missing:
+                    self.vacuum_cache.put(keys[i], values[i])
+            probabilities[:, selected] = values[inverse.reshape(-1)].reshape(n_sets, len(selected))
+        return probabilities
+
+
 class TheoreticalProbabilities:
+    """Theoretical probabilities of GBS experiments. The covariance matrices of the
+    output states are computed in closed form by default (see get_cov_matrix); with
+    cov_backend='sf' they are obtained by simulating the circuit in Strawberry Fields
+    (see get_cov_matrix_sf and get_noisy_cov_matrix_sf) instead.
+
+    The functions which return many marginals compute them with marginal_engine:
+    the inclusion-exclusion transform of the vacuum probabilities by default (see
+    get_marginal_distribution_from_vacuum_probabilities), or one torontonian per
+    detection pattern with marginal_engine='tor'. The GBS states keep caches of at
+    most cache_size entries (see GBSState)."""
+
+    def __init__(self, cov_backend: str = 'analytic', marginal_engine: str = 'mobius', cache_size: int = 2**20):
+        if cov_backend not in ('analytic', 'sf'):
+            raise ValueError("cov_backend must be 'analytic' or 'sf'")
+        if marginal_engine not in ('mobius', 'tor'):
+            raise ValueError("marginal_engine must be 'mobius' or 'tor'")
+        self.cov_backend = cov_backend
+        self.marginal_engine = marginal_engine
+        self.cache_size = cache_size
+        self._state_key = None
+        self._state = None
 
     def Ch(self, r: float) -> np.ndarray:
         """Returns Ch submatrix of the squeezing vector."""
@@ -83,14 +223,8 @@ class TheoreticalProbabilities:
 
         Returns the reduced matrix associated with the input mode indices.
         '''
-        indices = copy.deepcopy(R)
-        for i in R:         
-            indices.append(int(i + len(sigma)/2))
-        sigma_red = np.empty((len(indices),len(indices)), dtype=complex)
-        for r_index, row in enumerate(indices):
-            for c_index, column in enumerate(indices):
-                sigma_red[r_index, c_index] = sigma[row, column]
-        return sigma_red
+        indices = np.concatenate((R, np.asarray(R) + len(sigma)//2)).astype(int)
+        return np.asarray(sigma, dtype=complex)[np.ix_(indices, indices)]
 
     def get_reduced_B(self, sigma: np.ndarray, R: List) -> np.ndarray:
         '''
@@ -101,12 +235,8 @@ class TheoreticalProbabilities:
 
         Returns the reduced matrix associated with the input mode indices.
         '''
-        indices = copy.deepcopy(R)
-        sigma_red = np.empty((len(indices),len(indices)), dtype=complex)
-        for r_index, row in enumerate(indices):
-            for c_index, column in enumerate(indices):
-                sigma_red[r_index, c_index] = sigma[row, column]
-        return sigma_red
+        indices = np.asarray(R, dtype=int)
+        return np.asarray(sigma, dtype=complex)[np.ix_(indices, indices)]
 
     def get_prob_all_zero_bitstring(self, cov_matrix: np.ndarray) -> float:
         """Calculates the probability of the outcome with no photon detections from
@@ -151,6 +281,32 @@ class TheoreticalProbabilities:
         term = np.identity(dim) - inverse_Q_matrix
         return np.dot(X_matrix, term)
 
+    def get_cov_matrix(
+        self,
+        matrix: np.ndarray,
+        squeezing_params: np.ndarray,
+        loss: Union[float, np.ndarray, None] = None
+    ) -> np.ndarray:
+        """Returns the covariance matrix of the output state of a GBS experiment in
+        closed form, without building a circuit, in the conventions of Strawberry
+        Fields (xxpp ordering, hbar = 2). Single-mode squeezed states with the given
+        squeezing parameters go through the interferometer matrix, which may be a
+        unitary or a non-unitary transformation matrix T, and then through the loss
+        beamsplitters of get_noisy_cov_matrix_sf if loss is given (one angle for all
+        the modes or one per mode), which multiply the rows of T by cos(loss).
+
+        A transformation T takes the covariance matrix sigma to O sigma O^T + I - O O^T,
+        where O = [[Re T, -Im T], [Im T, Re T]], so the vacuum fills what is lost."""
+        matrix = np.asarray(matrix, dtype=complex)
+        squeezing_params = np.asarray(squeezing_params, dtype=float)
+        if len(squeezing_params) != matrix.shape[1]:
+            raise Exception('r_k and U must have the same length')
+        if loss is not None:
+            matrix = np.cos(np.broadcast_to(loss, len(matrix)))[:, np.newaxis] * matrix
+        O = np.block([[matrix.real, -matrix.imag], [matrix.imag, matrix.real]])
+        input_variances = np.concatenate((np.exp(-2*squeezing_params), np.exp(2*squeezing_params)))
+        return (O * input_variances) @ O.T + np.identity(len(O)) - O @ O.T
+
     def get_cov_matrix_sf(self,
         unitary: np.ndarray, 
         squeezing_params: np.ndarray,
@@ -180,6 +336,33 @@ class TheoreticalProbabilities:
         state = eng.run(prog).state
         return state.cov()
 
+    def get_gbs_state(
+        self,
+        unitary: np.ndarray,
+        squeezing_params: np.ndarray,
+        loss: Union[float, np.ndarray, None] = None
+    ) -> GBSState:
+        """Returns the GBSState of the ideal (or, if loss is given, lossy) GBS experiment
+        with the given unitary and squeezing parameters. The loss is the beamsplitter
+        angle of get_noisy_cov_matrix_sf, and may be given per mode with the analytic
+        backend. The covariance matrix is only computed once: the state of the last
+        parameters asked for is kept and reused, so the methods below which take a
+        unitary and squeezing parameters share one state (and its caches) across all
+        the marginals they are asked for."""
+        unitary = np.asarray(unitary)
+        key = (unitary.shape, unitary.tobytes(), tuple(np.asarray(squeezing_params).tolist()),
+               None if loss is None else tuple(np.atleast_1d(loss).tolist()))
+        if key != self._state_key:
+            if self.cov_backend == 'analytic':
+                cov_matrix = self.get_cov_matrix(unitary, squeezing_params, loss)
+            elif loss is None:
+                cov_matrix = self.get_cov_matrix_sf(unitary, squeezing_params)
+            else:
+                cov_matrix = self.get_noisy_cov_matrix_sf(unitary, squeezing_params, loss)
+            self._state = GBSState(cov_matrix, len(squeezing_params), self.cache_size)
+            self._state_key = key
+        return self._state
+
     def get_single_outcome_probability_from_tor(
         self,
         bitstring: Tuple,
@@ -220,29 +403,120 @@ class TheoreticalProbabilities:
         r_k: np.ndarray
     ) -> np.ndarray:
         """Returns marginal distribution of the specified modes using the Torontonian."""
-        cov_matrix = thewalrus.quantum.Qmat(self.get_cov_matrix_sf(interferometer_matrix, r_k))
-        k_order = len(mode_indices)
-        binary_basis = get_binary_basis(k_order)
-        reduced_sigma = self.get_reduced_matrix(cov_matrix, mode_indices)
-        distr = [self.get_single_outcome_probability_from_tor(string, reduced_sigma).real for string in binary_basis]
+        state = self.get_gbs_state(interferometer_matrix, r_k)
+        return self.get_marginal_distribution_from_state(state, mode_indices)
+
+    def get_marginal_distribution_from_state(
+        self,
+        state: GBSState,
+        mode_indices: List
+    ) -> np.ndarray:
+        """Returns marginal distribution of the specified modes using the Torontonian,
+        from the cached quantities of the GBS state. The probability of a detection
+        pattern with clicks in the set S is tor(I - (Q_R^-1)_S)/sqrt(det(Q_R)), with
+        Q_R the reduced Q matrix of the marginal, so Q_R is only inverted once."""
+        inverse, logdet = state.get_reduced_inverse_and_logdet(mode_indices)
+        return self._get_marginal_distribution_from_reduced_inverse(inverse, logdet)
+
+    def get_marginal_distribution_from_vacuum_probabilities(
+        self,
+        state: GBSState,
+        mode_indices: List
+    ) -> np.ndarray:
+        """Returns marginal distribution of the specified modes from the probabilities
+        of no clicks in each of their 2^k subsets (see GBSState.get_vacuum_probabilities),
+        which are turned into the probabilities of the detection patterns by a fast
+        inclusion-exclusion (Mobius) transform: going through the modes one at a time,
+        P(no clicks in B, click in m) = P(no clicks in B) - P(no clicks in B and m).
+        This needs 2^k determinants and k*2^(k-1) subtractions, instead of the 3^k
+        determinants of one torontonian per pattern, and gives the probability of
+        the all-zero pattern directly."""
+        return self.get_marginal_distributions_from_vacuum_probabilities(state, np.array([mode_indices]))[0]
+
+    def get_marginal_distributions_from_vacuum_probabilities(
+        self,
+        state: GBSState,
+        modes: np.ndarray
+    ) -> np.ndarray:
+        """Batched version of get_marginal_distribution_from_vacuum_probabilities for a
+        (B, k) array of mode sets, which returns a (B, 2^k) array. The vacuum
+        probabilities of all the marginals are computed together (see
+        GBSState.get_vacuum_probabilities_batch) and transformed at once."""
+        modes = np.asarray(modes, dtype=int)
+        n_sets, k_order = modes.shape
+        distr = state.get_vacuum_probabilities_batch(modes).reshape((n_sets,) + (2,)*k_order)
+        for axis in range(1, k_order + 1):
+            mode_axis = np.moveaxis(distr, axis, 0)
+            mode_axis[0] -= mode_axis[1]
+        # Indexed by the modes with no clicks, so the detection patterns are reversed
+        return distr.reshape(n_sets, -1)[:, ::-1].copy()
+
+    def get_marginal_distribution_from_mobius(
+        self,
+        mode_indices: List,
+        interferometer_matrix: np.ndarray,
+        r_k: np.ndarray
+    ) -> np.ndarray:
+        """Version of get_marginal_distribution_from_tor which uses the inclusion-exclusion
+        transform of get_marginal_distribution_from_vacuum_probabilities."""
+        state = self.get_gbs_state(interferometer_matrix, r_k)
+        return self.get_marginal_distribution_from_vacuum_probabilities(state, mode_indices)
+
+    def _get_marginal_distribution(self, state: GBSState, mode_indices: List) -> np.ndarray:
+        """Returns marginal distribution of the specified modes with the marginal engine."""
+        if self.marginal_engine == 'mobius':
+            return self.get_marginal_distribution_from_vacuum_probabilities(state, mode_indices)
+        return self.get_marginal_distribution_from_state(state, mode_indices)
+
+    def _get_marginal_table(self, state: GBSState, modes: np.ndarray) -> MarginalTable:
+        """Returns the table of the marginals of the mode sets in the (M, k) array modes
+        with the marginal engine, which computes them as a single batch."""
+        modes = np.asarray(modes, dtype=int).reshape(len(modes), -1)
+        if self.marginal_engine == 'mobius':
+            return MarginalTable(modes, self.get_marginal_distributions_from_vacuum_probabilities(state, modes))
+        return MarginalTable(modes, [self.get_marginal_distribution_from_state(state, list(m)) for m in modes])
+
+    def _get_marginal_distribution_from_reduced_inverse(
+        self,
+        inverse_reduced_Q: np.ndarray,
+        logdet: float
+    ) -> np.ndarray:
+        """Returns the marginal distribution of the modes of a reduced Q matrix given
+        its inverse and its log-determinant (see get_marginal_distribution_from_state)."""
+        k_order = len(inverse_reduced_Q) // 2
+        normalisation = np.exp(-0.5 * logdet)
+        distr = np.zeros(2**k_order)
+        for outcome, string in enumerate(get_binary_basis(k_order)):
+            set_S = get_click_indices(string)
+            if set_S:
+                inds = np.concatenate((set_S, np.asarray(set_S) + k_order))
+                O_s = np.identity(len(inds)) - inverse_reduced_Q[np.ix_(inds, inds)]
+                distr[outcome] = (tor(O_s) * normalisation).real
         distr[0] = 1 - np.sum(distr[1:])
-        return np.array(distr)
-    
+        return distr
+
     def get_noisy_marginal_distribution_from_tor(
         self,
         mode_indices: List,
         interferometer_matrix: np.ndarray,
         r_k: np.ndarray,
-        loss: float
+        loss: Union[float, np.ndarray]
     ) -> np.ndarray:
         """Returns noisy marginal distribution of the specified modes using the Torontonian."""
-        cov_matrix = thewalrus.quantum.Qmat(self.get_noisy_cov_matrix_sf(interferometer_matrix, r_k, loss))
-        k_order = len(mode_indices)
-        binary_basis = get_binary_basis(k_order)
-        reduced_sigma = self.get_reduced_matrix(cov_matrix, mode_indices)
-        distr = [self.get_single_outcome_probability_from_tor(string, reduced_sigma).real for string in binary_basis]
-        distr[0] = 1 - np.sum(distr[1:])
-        return np.array(distr)
+        state = self.get_gbs_state(interferometer_matrix, r_k, loss)
+        return self.get_marginal_distribution_from_state(state, mode_indices)
+
+    def get_noisy_marginal_distribution_from_mobius(
+        self,
+        mode_indices: List,
+        interferometer_matrix: np.ndarray,
+        r_k: np.ndarray,
+        loss: Union[float, np.ndarray]
+    ) -> np.ndarray:
+        """Version of get_noisy_marginal_distribution_from_tor which uses the
+        inclusion-exclusion transform of get_marginal_distribution_from_vacuum_probabilities."""
+        state = self.get_gbs_state(interferometer_matrix, r_k, loss)
+        return self.get_marginal_distribution_from_vacuum_probabilities(state, mode_indices)
     
     def get_marginal_distribution_from_haf(
         self,
@@ -269,15 +543,12 @@ class TheoreticalProbabilities:
         squeezing_params: np.ndarray,
         unitary: np.ndarray,
         k_order: int,
-    ) -> np.ndarray:
+    ) -> MarginalTable:
         """Returns the theoretical k-th order marginals of a GBS experiment with the given
         number of modes, squeezing parameters, and the interferometer unitary."""
-        comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
-        marginals : List = []
-        for modes in comb:
-            marg = self.get_marginal_distribution_from_tor(modes, unitary, squeezing_params)
-            marginals.append([modes, marg])
-        return np.array(marginals)
+        state = self.get_gbs_state(unitary, squeezing_params)
+        comb = np.array(list(combinations(range(n_modes), k_order)))
+        return self._get_marginal_table(state, comb)
     
     def get_all_noisy_marginals_from_torontonian(
         self,
@@ -285,16 +556,83 @@ class TheoreticalProbabilities:
         squeezing_params: np.ndarray,
         unitary: np.ndarray,
         k_order: int,
-        loss: float
-    ) -> np.ndarray:
+        loss: Union[float, np.ndarray]
+    ) -> MarginalTable:
         """Returns the theoretical k-th order, noisy marginals of a GBS experiment with the given
         number of modes, squeezing parameters, and the interferometer unitary."""
-        comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
-        marginals : List = []
-        for modes in comb:
-            marg = self.get_noisy_marginal_distribution_from_tor(modes, unitary, squeezing_params, loss)
-            marginals.append([modes, marg])
-        return np.array(marginals)
+        state = self.get_gbs_state(unitary, squeezing_params, loss)
+        comb = np.array(list(combinations(range(n_modes), k_order)))
+        return self._get_marginal_table(state, comb)
+    
+    def get_all_ideal_marginals_with_fixed_n_clicks_from_torontonian(
+        self,
+        n_modes: int,
+        squeezing_params: np.ndarray,
+        unitary: np.ndarray,
+        k_order: int,
+        n_clicks: int
+    ) -> MarginalTable:
+        """Returns the theoretical k-th order marginals of a GBS experiment conditioned on
+        detecting exactly n_clicks clicks, which are the inputs of the greedy algorithm
+        with a fixed number of clicks (see Greedy.get_S_matrix). They are obtained from
+        the full distribution over all the modes, so the cost grows as 2^n_modes."""
+        state = self.get_gbs_state(unitary, squeezing_params)
+        full_distr = self._get_marginal_distribution(state, list(range(n_modes)))
+        return MarginalTable.from_distribution(full_distr, k_order, n_clicks)
+
+    def get_click_correlations(self, Q_matrix: np.ndarray) -> np.ndarray:
+        """Returns the matrix of covariances between the click outcomes of every pair of
+        modes, P(no click in i and j) - P(no click in i)P(no click in j), given the Q
+        matrix of the output state. The probability of no clicks in a set of modes B is
+        1/sqrt(det(Q_B)), so only 2x2 and 4x4 determinants are needed."""
+        n_modes = len(Q_matrix) // 2
+        modes = np.arange(n_modes)
+        single_inds = np.stack([modes, modes + n_modes], axis=1)
+        p_vacuum = (1 / np.sqrt(np.linalg.det(Q_matrix[single_inds[:, :, None], single_inds[:, None, :]]))).real
+        i, j = np.triu_indices(n_modes, 1)
+        pair_inds = np.stack([i, j, i + n_modes, j + n_modes], axis=1)
+        p_pair_vacuum = (1 / np.sqrt(np.linalg.det(Q_matrix[pair_inds[:, :, None], pair_inds[:, None, :]]))).real
+        correlations = np.zeros((n_modes, n_modes))
+        correlations[i, j] = p_pair_vacuum - p_vacuum[i] * p_vacuum[j]
+        return correlations + correlations.T
+
+    def get_screened_mode_subsets(
+        self,
+        Q_matrix: np.ndarray,
+        k_order: int,
+        n_subsets: int
+    ) -> np.ndarray:
+        """Ranks all k-mode subsets by the sum of the absolute click correlations of
+        their pairs of modes (see get_click_correlations) and returns the n_subsets
+        highest ranked ones, as an (n_subsets, k) array in the order of the
+        combinations function of itertools."""
+        n_modes = len(Q_matrix) // 2
+        correlations = np.abs(self.get_click_correlations(Q_matrix))
+        subsets = np.array(list(combinations(range(n_modes), k_order)))
+        scores = np.zeros(len(subsets))
+        for a, b in combinations(range(k_order), 2):
+            scores += correlations[subsets[:, a], subsets[:, b]]
+        if n_subsets < len(subsets):
+            subsets = subsets[np.sort(np.argpartition(-scores, n_subsets)[:n_subsets])]
+        return subsets
+
+    def get_screened_ideal_marginals_from_torontonian(
+        self,
+        n_modes: int,
+        squeezing_params: np.ndarray,
+        unitary: np.ndarray,
+        k_order: int,
+        n_subsets: int
+    ) -> List[MarginalTable]:
+        """Returns the marginals of every mode and of every prefix of the n_subsets most
+        correlated k-mode subsets, one MarginalTable per order, for Greedy.get_S_matrix_from_sparse_marginals."""
+        state = self.get_gbs_state(unitary, squeezing_params)
+        subsets = self.get_screened_mode_subsets(state.Q_matrix, k_order, n_subsets)
+        tables = [self._get_marginal_table(state, np.arange(n_modes).reshape(-1, 1))]
+        for order in range(2, k_order + 1):
+            prefixes = np.unique(subsets[:, :order], axis=0)
+            tables.append(self._get_marginal_table(state, prefixes))
+        return tables
 
 
 
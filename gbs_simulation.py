@@ -4,6 +4,7 @@ from typing import Tuple, List
 import itertools as iter
 from utils import bitstring_to_int, convert_to_clicks
 from itertools import combinations
+from marginal_table import MarginalTable
 from gbs_circuits import (get_ideal_gbs_circuit, get_gbs_circuit_with_optical_loss, get_gbs_circuit_with_gate_error,
                          get_gbs_circuit_with_distinguishable_photons, get_gbs_circuit_with_loss_channel)
 import copy
@@ -158,19 +159,18 @@ class GBS_simulation:
         squeezing_params: np.ndarray,
         unitary: np.ndarray,
         k_order: int
-    ) -> np.ndarray:
+    ) -> MarginalTable:
         """Gets ground truth k-th order marginals from the output statevector of the Strawberry
         Fields simulation of a GBS experiment with the given number of modes, squeezing
         parameters and unitary matrix (defining the interferometer). The fock cutoff defines
-        the truncation of the fock basis in the simulation. Returns an array where each element
-        has two sublists. The first one is the set of mode indices of that marginal, and the 
-        second one is the marginal distribution."""
+        the truncation of the fock basis in the simulation. Returns a MarginalTable
+        with the mode indices of every marginal and its distribution."""
         comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
         marginals : List = []
         for modes in comb:
             marg = self.get_ideal_marginal_from_gaussian_simulation(n_modes, fock_cutoff, squeezing_params, unitary, modes)
             marginals.append([modes, marg])
-        return np.array(marginals)
+        return MarginalTable.from_pairs(marginals)
     
     def get_all_lossy_marginals_from_gaussian_simulation(
         self,
@@ -180,20 +180,19 @@ class GBS_simulation:
         unitary: np.ndarray,
         k_order: int,
         loss: float = 0.5
-    ) -> np.ndarray:
+    ) -> MarginalTable:
         """Gets ground truth k-th order marginals from the output statevector of the Strawberry
         Fields simulation of a GBS experiment (incorporating optical loss) with the given number
         of modes, squeezing parameters and the interferometer unitary. The fock cutoff defines
-        the truncation of the fock basis in the simulation. Returns an array where each element
-        has two sublists. The first one is the set of mode indices of that marginal, and the 
-        second one is the marginal distribution. The loss factor goes from 0 (no loss) to pi/2
-        (maximum loss)."""
+        the truncation of the fock basis in the simulation. Returns a MarginalTable
+        with the mode indices of every marginal and its distribution. The loss factor goes
+        from 0 (no loss) to pi/2 (maximum loss)."""
         comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
         marginals : List = []
         for modes in comb:
             marg = self.get_lossy_marginal_from_gaussian_simulation(n_modes, fock_cutoff, squeezing_params, unitary, modes, loss)
             marginals.append([modes, marg])
-        return np.array(marginals)
+        return MarginalTable.from_pairs(marginals)
     
     def get_all_lossy_marginals_from_fock_simulation(
         self,
@@ -203,20 +202,19 @@ class GBS_simulation:
         unitary: np.ndarray,
         k_order: int,
         loss: float = 0.5
-    ) -> np.ndarray:
+    ) -> MarginalTable:
         """Gets ground truth k-th order marginals from the output statevector of the Strawberry
         Fields simulation of a GBS experiment (incorporating optical loss) with the given number
         of modes, squeezing parameters and the interferometer unitary. The fock cutoff defines
-        the truncation of the fock basis in the simulation. Returns an array where each element
-        has two sublists. The first one is the set of mode indices of that marginal, and the 
-        second one is the marginal distribution. The loss factor goes from 0 (no loss) to pi/2
-        (maximum loss)."""
+        the truncation of the fock basis in the simulation. Returns a MarginalTable
+        with the mode indices of every marginal and its distribution. The loss factor goes
+        from 0 (no loss) to pi/2 (maximum loss)."""
         comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
         marginals : List = []
         for modes in comb:
             marg = self.get_lossy_marginal_from_fock_simulation(n_modes, fock_cutoff, squeezing_params, unitary, modes, loss)
             marginals.append([modes, marg])
-        return np.array(marginals)
+        return MarginalTable.from_pairs(marginals)
     
     def get_marginal_from_simulation_with_distinguishable_photons(
         self,
@@ -253,19 +251,18 @@ class GBS_simulation:
         unitary: np.ndarray,
         k_order: int,
         squeezing_imperfection: float = 0.2
-    ) -> np.ndarray:
+    ) -> MarginalTable:
         """Gets ground truth k-th order marginals from the output statevector of the Strawberry
         Fields simulation of a GBS experiment (incorporating distinguishability) with the given number
         of modes, squeezing parameters and the interferometer unitary. The fock cutoff defines
-        the truncation of the fock basis in the simulation. Returns an array where each element
-        has two sublists. The first one is the set of mode indices of that marginal, and the 
-        second one is the marginal distribution."""
+        the truncation of the fock basis in the simulation. Returns a MarginalTable
+        with the mode indices of every marginal and its distribution."""
         comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
         marginals : List = []
         for modes in comb:
             marg = self.get_marginal_from_simulation_with_distinguishable_photons(n_modes, fock_cutoff, squeezing_params, unitary, modes, squeezing_imperfection)
             marginals.append([modes, marg])
-        return np.array(marginals)
+        return MarginalTable.from_pairs(marginals)
     
     def turn_detections_into_projection_operators(
         self, 
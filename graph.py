@@ -7,6 +7,8 @@ from tqdm import tqdm
 from gbs_simulation import GBS_simulation
 from gbs_probabilities import TheoreticalProbabilities
 from greedy import Greedy
+from click_matrix import ClickMatrix, SparseClickMatrix
+from typing import Union
 import copy
 from scipy.optimize import fsolve
 
@@ -19,15 +21,13 @@ class Graph():
 
     def get_submatrix_with_fixed_n_clicks(
         self,
-        S_matrix: np.ndarray,
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix],
         n: int
     ) -> np.ndarray:
-        submatrix = []
-        for elem in S_matrix:
-            count = np.count_nonzero(elem == 1.0)
-            if count == n:
-                submatrix.append(elem)
-        return np.array(submatrix)
+        '''Returns the rows of the S matrix (dense, packed or click lists) with exactly n clicks.'''
+        if isinstance(S_matrix, (ClickMatrix, SparseClickMatrix)):
+            return S_matrix.get_rows_with_n_clicks(n).to_dense()
+        return S_matrix[np.count_nonzero(S_matrix, axis=1) == n]
 
 
     def adj_to_GBS(self, G_adj):
@@ -137,8 +137,10 @@ class Graph():
 
 
 
-    def greedy_search(self, G, k, n, repetitions = 400, L = 2000):
-
+    def greedy_search(self, G, k, n, repetitions = 400, L = 2000, fixed_n_clicks = False):
+        '''The rows of the greedy matrices with k clicks are used as samples. If
+        fixed_n_clicks, every row is built with exactly k clicks from the marginals
+        conditioned on k clicks, so none are discarded; these marginals cost 2^N.'''
         adj = self.nx_adj(G)
         N = G.number_of_nodes()
         s_i, U = self.adj_to_GBS(adj)
@@ -150,7 +152,11 @@ class Graph():
 
 
         probs = TheoreticalProbabilities()
-        ideal_margs = probs.get_all_ideal_marginals_from_torontonian(N, s_ideal, U, 2)
+        if fixed_n_clicks:
+            ideal_margs = probs.get_all_ideal_marginals_with_fixed_n_clicks_from_torontonian(N, s_ideal, U, 2, k)
+        else:
+            ideal_margs = probs.get_all_ideal_marginals_from_torontonian(N, s_ideal, U, 2)
+        n_clicks = k if fixed_n_clicks else None
         print('here1')
         maxima = []
 
@@ -161,11 +167,11 @@ class Graph():
                 del self.extra_samples[:n]
                 print('got extra samples and deleted')
             else:
-                S_matrix = Greedy().get_S_matrix(N, L, 2, ideal_margs)
+                S_matrix = Greedy().get_S_matrix(N, L, 2, ideal_margs, packed=True, n_clicks=n_clicks)
                 print(f'S matrix generated with L = {L} ')
                 # print(S_matrix)
                 # print('k=',k)
-                greedy_samples_array = self.get_submatrix_with_fixed_n_clicks(S_matrix, k)
+                greedy_samples_array = S_matrix.to_dense() if fixed_n_clicks else self.get_submatrix_with_fixed_n_clicks(S_matrix, k)
                 greedy_samples = list(greedy_samples_array)
                 self.extra_samples += greedy_samples
                 # print(f'now here, greedy samples = {greedy_samples}')
@@ -174,8 +180,8 @@ class Graph():
 
             while (len(self.extra_samples)) < n:
                 print(f'more samples for n={n}')
-                more_S_matrix = Greedy().get_S_matrix(N, 2000, 2, ideal_margs)
-                more_greedy_samples = list(self.get_submatrix_with_fixed_n_clicks(more_S_matrix, k))
+                more_S_matrix = Greedy().get_S_matrix(N, 2000, 2, ideal_margs, packed=True, n_clicks=n_clicks)
+                more_greedy_samples = list(more_S_matrix.to_dense() if fixed_n_clicks else self.get_submatrix_with_fixed_n_clicks(more_S_matrix, k))
                 # print('more greedy samples before concatenation =', more_greedy_samples)
                 # print('dimension of more samples=', more_greedy_samples.shape)
                 greedy_samples += more_greedy_samples
@@ -199,7 +205,11 @@ class Graph():
         avg_maximum = np.sum(maxima)/repetitions
         return avg_maximum
 
-    def greedy_search2(self, G, k, n_range, repetitions = 400, L = 2000):
+    def greedy_search2(self, G, k, n_range, repetitions = 400, L = 2000, chunk_size = 200, fixed_n_clicks = False):
+        '''The greedy samples are streamed in chunks of chunk_size rows (see
+        Greedy.stream_S_matrix), so the rows with k clicks of the first chunk can
+        be used before the rest of the L-row greedy matrix is built. A new stream
+        is started every L rows. fixed_n_clicks is used as in greedy_search.'''
         adj = self.nx_adj(G)
         N = G.number_of_nodes()
         s_i, U = self.adj_to_GBS(adj)
@@ -208,8 +218,13 @@ class Graph():
         s_ideal = [self.get_scaled_squeezing(k, N, 0)] * N
         print(f's_ideal= {s_ideal}')
         probs = TheoreticalProbabilities()
-        ideal_margs = probs.get_all_ideal_marginals_from_torontonian(N, s_ideal, U, 2)
+        if fixed_n_clicks:
+            ideal_margs = probs.get_all_ideal_marginals_with_fixed_n_clicks_from_torontonian(N, s_ideal, U, 2, k)
+        else:
+            ideal_margs = probs.get_all_ideal_marginals_from_torontonian(N, s_ideal, U, 2)
+        n_clicks = k if fixed_n_clicks else None
         print('here1')
+        stream = Greedy().stream_S_matrix(N, L, 2, ideal_margs, chunk_size, n_clicks=n_clicks)
         avg_maxima = []
         std_devs = []
 
@@ -222,9 +237,12 @@ class Graph():
                 print(f'length of extra samples = {len(self.sl)}')
 
                 while len(self.sl) < n:
-                    S_matrix = Greedy().get_S_matrix(N, L, 2, ideal_margs)
-                    print(f'S matrix generated with L = {L} ')
-                    subset = list(self.get_submatrix_with_fixed_n_clicks(S_matrix, k))
+                    chunk, _ = next(stream, (None, None))
+                    if chunk is None:
+                        stream = Greedy().stream_S_matrix(N, L, 2, ideal_margs, chunk_size, n_clicks=n_clicks)
+                        print(f'new greedy stream started with L = {L} ')
+                        continue
+                    subset = list(chunk if fixed_n_clicks else self.get_submatrix_with_fixed_n_clicks(chunk, k))
                     print(f'length of subset = {len(subset)}')
                     self.sl += subset
 
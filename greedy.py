@@ -1,216 +1,1235 @@
-import copy
-from typing import List, Tuple
+from typing import Iterator, List, Tuple, Union
 import numpy as np
-from collections import Counter
-from utils import bitstring_to_int, int_to_padded_bitstring, total_variation_distance, kl_divergence
-from itertools import combinations
+from utils import get_binary_basis, total_variation_distance, write_file_atomically
+from concurrent.futures import ProcessPoolExecutor
+import os
+import json
+import hashlib
+from click_matrix import ClickMatrix, ClickMatrixStore, SparseClickMatrix
+from marginal_table import MarginalTable, as_marginal_table
+from objectives import Objective, TotalVariationDistance
+
+
+class GreedyState():
+    """Running count tables of the marginals considered in one iteration of the
+    greedy algorithm. Each table holds the number of times every outcome of that
+    marginal appears in the rows filled so far, so a candidate bitstring can be
+    scored by the change it makes to the objective (the total variation distance
+    by default, see objectives.py) without rebuilding the empirical distributions
+    from the S matrix.
+
+    Candidates are scored with trial(), which leaves the tables untouched, and
+    the chosen one is added with commit(). The scratch arrays used for scoring
+    are allocated once, so filling a row does not allocate anything that depends
+    on the number of rows of the S matrix.
+
+    The tables have a leading ensemble axis with one entry per independent S
+    matrix (n_members), so that the rows of several matrices can be scored in
+    a single vectorised call.
+
+    base_counts (with shape (marginals, outcomes)) are the count tables of rows
+    that are already final, e.g. earlier chunks of a stream. They are added to
+    the tables so that the new rows are fitted together with them."""
+
+    def __init__(
+        self,
+        ideal_distrs: MarginalTable,
+        n_members: int = 1,
+        base_counts: Union[np.ndarray, None] = None,
+        objective: Union[Objective, None] = None
+    ):
+        self.objective = TotalVariationDistance() if objective is None else objective
+        self.modes = ideal_distrs.modes
+        self.ideal = ideal_distrs.probabilities
+        n_marginals, n_outcomes = self.ideal.shape
+        self.counts = np.zeros((n_members, n_marginals, n_outcomes))
+        self.n_rows = 0
+        if base_counts is not None:
+            self.counts[:] = base_counts
+            self.n_rows = int(round(np.sum(base_counts[0])))
+        self.k_order = self.modes.shape[1]
+        bit_weights = 2**np.arange(self.k_order - 1, -1, -1)
+        self._prefix_modes = self.modes[:, :-1]
+        self._prefix_weights = bit_weights[:-1]
+        self._ideal_offsets = (np.arange(n_marginals) * n_outcomes).reshape(1, 1, -1)
+        self._count_offsets = self._ideal_offsets + (np.arange(n_members) * n_marginals * n_outcomes).reshape(-1, 1, 1)
+        self.first_column_candidates = np.arange(n_outcomes).reshape(-1, 1)
+        self.first_column_bits = np.array(get_binary_basis(self.k_order), dtype=np.uint8)
+        self.first_column_clicks = np.sum(self.first_column_bits, axis=1)
+        n_candidates = max(2, n_outcomes)
+        shape = (n_members, n_candidates, n_marginals)
+        self._candidates = np.empty((n_members, 2, n_marginals), dtype=int)
+        self._ideal_inds = np.empty(shape, dtype=int)
+        self._count_inds = np.empty(shape, dtype=int)
+        self._ideal_buffer = np.empty(shape)
+        self._counts_buffer = np.empty(shape)
+        self._change_buffer = np.empty(shape)
+        self._scores = np.empty((n_members, n_candidates))
+
+    def get_candidates(self, rows: np.ndarray) -> np.ndarray:
+        """Takes the row being filled of every member of the ensemble (a single
+        row if there is only one) and returns the two candidate outcomes (in
+        decimal) of every marginal, i.e. with the bit of the last mode set to 0
+        and to 1, as an array with shape (members, 2, marginals)."""
+        rows = rows.reshape(len(self._candidates), -1)
+        np.matmul(rows[:, self._prefix_modes], self._prefix_weights, out=self._candidates[:, 0], casting='unsafe')
+        np.add(self._candidates[:, 0], 1, out=self._candidates[:, 1])
+        return self._candidates
+
+    def trial(self, codes: np.ndarray) -> np.ndarray:
+        """Takes an array of candidate outcomes with shape (candidates, marginals),
+        or (members, candidates, marginals) if every member has its own candidates,
+        and returns an array with shape (members, candidates) with the change in
+        the summed objective caused by adding each candidate as the next row. The
+        objective before the row is added is the same for all candidates, so only
+        the counts of the candidate outcomes have to be looked at. The returned
+        array is overwritten by the next trial."""
+        n_candidates = codes.shape[-2]
+        n_rows = self.n_rows + 1
+        ideal_inds = self._ideal_inds[:, :n_candidates]
+        count_inds = self._count_inds[:, :n_candidates]
+        ideal = self._ideal_buffer[:, :n_candidates]
+        counts = self._counts_buffer[:, :n_candidates]
+        change = self._change_buffer[:, :n_candidates]
+        np.add(codes, self._ideal_offsets, out=ideal_inds)
+        np.add(codes, self._count_offsets, out=count_inds)
+        np.take(self.ideal, ideal_inds, out=ideal)
+        np.take(self.counts, count_inds, out=counts)
+        self.objective.add_count_changes(ideal, counts, codes, n_rows, out=change)
+        scores = self._scores[:, :n_candidates]
+        np.sum(change, axis=2, out=scores)
+        return scores
+
+    def commit(self, codes: np.ndarray) -> None:
+        """Adds the outcomes of a new row to the count tables. The codes have
+        shape (marginals,), or (members, marginals) for different outcomes in
+        every member of the ensemble."""
+        inds = self._count_inds[:, 0]
+        np.add(codes, self._count_offsets[:, 0], out=inds)
+        np.add.at(self.counts.reshape(-1), inds, 1)
+        self.n_rows += 1
+
+    def get_variation_distances(self) -> np.ndarray:
+        """Returns the variation distance of every marginal with respect to the
+        empirical marginals of the rows added so far, with shape (members, marginals)."""
+        return 0.5 * np.sum(np.abs(self.ideal - self.counts / self.n_rows), axis=2)
+
+
+class LocalSearchState():
+    """Count tables of all the marginals of a finished S matrix, together with the
+    outcome (in decimal) of every row in every marginal, used to refine the matrix
+    with bit flips. Flipping the bit of one mode in one row only changes the
+    outcomes of the C(n-1,k-1) marginals which contain that mode, so the change in
+    the summed objective (see objectives.py) caused by a flip is evaluated by
+    looking at two counts of each of those marginals, without rebuilding any
+    distribution."""
+
+    def __init__(self, S_matrix: np.ndarray, marginals: MarginalTable, objective: Union[Objective, None] = None):
+        self.objective = TotalVariationDistance() if objective is None else objective
+        self.S_matrix = S_matrix
+        self.ideal = marginals.probabilities
+        self.n_rows, n_modes = S_matrix.shape
+        n_marginals, n_outcomes = self.ideal.shape
+        bit_weights = 2**np.arange(marginals.k_order - 1, -1, -1)
+        self.codes = S_matrix[:, marginals.modes].astype(np.int64) @ bit_weights
+        self.counts = np.bincount(
+            (self.codes + np.arange(n_marginals) * n_outcomes).reshape(-1),
+            minlength=n_marginals * n_outcomes
+        ).reshape(n_marginals, n_outcomes).astype(float)
+        self.mode_marginals: List = []
+        self.mode_bit_weights: List = []
+        for mode in range(n_modes):
+            marginal_inds, positions = np.nonzero(marginals.modes == mode)
+            self.mode_marginals.append(marginal_inds)
+            self.mode_bit_weights.append(bit_weights[positions])
+
+    def get_flip_delta(self, row: int, mode: int) -> float:
+        """Returns the change in the summed objective of the marginals caused by
+        flipping the bit of the given mode in the given row."""
+        inds = self.mode_marginals[mode]
+        old = self.codes[row, inds]
+        new = old ^ self.mode_bit_weights[mode]
+        outcomes = np.concatenate((old, new))
+        ideal = self.ideal[np.tile(inds, 2), outcomes]
+        counts = self.counts[np.tile(inds, 2), outcomes]
+        changes = np.concatenate((np.full(len(inds), -1), np.ones(len(inds))))
+        terms = self.objective.get_terms
+        delta = terms(ideal, (counts + changes) / self.n_rows, outcomes) - terms(ideal, counts / self.n_rows, outcomes)
+        return float(np.sum(delta))
+
+    def flip(self, row: int, mode: int) -> None:
+        """Flips the bit of the given mode in the given row and updates the counts."""
+        inds = self.mode_marginals[mode]
+        old = self.codes[row, inds]
+        new = old ^ self.mode_bit_weights[mode]
+        self.counts[inds, old] -= 1
+        self.counts[inds, new] += 1
+        self.codes[row, inds] = new
+        self.S_matrix[row, mode] ^= 1
+
+    def get_variation_distances(self) -> np.ndarray:
+        """Returns the variation distance of every marginal."""
+        return 0.5 * np.sum(np.abs(self.ideal - self.counts / self.n_rows), axis=1)
 
 
 class Greedy():
+    """Google's greedy algorithm. Candidate bitstrings are scored with the given
+    objective (see objectives.py), which is the total variation distance by default."""
 
-    def _get_submatrix_indices(
-        self, 
-        shape: Tuple[int, int], 
-        k_order: int, 
-        iteration_number: int
+    def __init__(self, objective: Union[Objective, None] = None):
+        self.objective = TotalVariationDistance() if objective is None else objective
+
+    def get_distribution_from_outcomes(
+        self,
+        samples: Union[np.ndarray, ClickMatrix, SparseClickMatrix, ClickMatrixStore]
     ) -> np.ndarray:
-        """Return the submatrix indices (tuples) of the submatrix with k columns + L rows
-        corresponding to the given iteration number."""
-        submatrix_indices = [index for index in np.ndindex(shape) if index[1]
-             in list(range(iteration_number, iteration_number + k_order))]
-        reshaped_inds = np.empty(len(submatrix_indices), dtype='object')
-        reshaped_inds[:] = submatrix_indices
-        reshaped_inds = reshaped_inds.reshape(shape[0], k_order)
-        return reshaped_inds
-
-    def get_distribution_from_outcomes(self, samples: np.ndarray) -> np.ndarray:
-        """Turns list of outcomes (bitstrings) into empirical distribution."""
-        bitstrings = [tuple(x) for x in samples]
-        sorted_decimal_list = np.sort([bitstring_to_int(binary) for binary in bitstrings])
-        count_dict = Counter(sorted_decimal_list)
-        counts = [count_dict.get(i, 0) for i in range(2**len(samples[0]))]
-        distribution = np.array(counts) / np.sum(counts)
-        return distribution
-    
-    def _get_marginal_variation_dist(
+        """Turns list of outcomes (bitstrings) into empirical distribution. Every
+        outcome is encoded as its decimal representation and the outcomes are
+        counted with a single bincount."""
+        if isinstance(samples, (ClickMatrix, SparseClickMatrix, ClickMatrixStore)):
+            return samples.get_distribution()
+        samples = np.asarray(samples) != 0
+        n_bits = samples.shape[1]
+        codes = samples.astype(np.int64) @ 2**np.arange(n_bits - 1, -1, -1)
+        counts = np.bincount(codes, minlength=2**n_bits)
+        return counts / np.sum(counts)
+
+    def get_empirical_marginals(
         self,
-        matrix: np.ndarray,
-        bit_indices: np.ndarray, 
-        ideal_marginal: np.ndarray
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix, ClickMatrixStore],
+        modes: np.ndarray,
+        chunk_size: int = 256,
+        max_elements: int = 2**22
     ) -> np.ndarray:
-        """Returns the variation distance between the ideal marginal and the
-        empirical marginal. The empirical marginal is calculated from all the
-        bitstrings up to the position specified by the bit_indices (including
-        this position)."""
-        row_index = bit_indices[0][0]
-        k_order = len(bit_indices)
-        column_inds = [bit_indices[j][1] for j in range(k_order)]
-        submatrix = matrix[0 : row_index + 1, column_inds]
-        empirical_distr = self.get_distribution_from_outcomes(submatrix)
-        return total_variation_distance(ideal_marginal, empirical_distr)
-    
-    def _get_marginal_kl_divergence(
+        """Returns the empirical marginal distributions of the rows of the S matrix
+        for every set of mode indices in modes (an (M, k) array), as an (M, 2^k) array.
+
+        The outcomes of chunk_size marginals at a time are encoded as integer codes,
+        offset by 2^k times the position of the marginal, so that all the marginals
+        of a chunk are counted with a single bincount. The rows are taken in blocks
+        of at most max_elements/chunk_size rows (a ClickMatrix is unpacked one block
+        at a time), so the memory used does not grow with the number of rows.
+        For a SparseClickMatrix only the clicks are scanned (see
+        _get_empirical_marginals_from_click_lists), and a ClickMatrixStore is
+        counted one chunk at a time."""
+        if isinstance(S_matrix, ClickMatrixStore):
+            counts = np.zeros((len(modes), 2**np.shape(modes)[1]))
+            for chunk in S_matrix.iter_chunks():
+                counts += self.get_empirical_marginals(chunk, modes, chunk_size, max_elements) * len(chunk)
+            return counts / len(S_matrix)
+        if isinstance(S_matrix, SparseClickMatrix):
+            return self._get_empirical_marginals_from_click_lists(S_matrix, modes, chunk_size)
+        if not isinstance(S_matrix, ClickMatrix):
+            S_matrix = np.asarray(S_matrix)
+        n_rows = len(S_matrix)
+        modes = np.asarray(modes)
+        n_marginals, k_order = modes.shape
+        n_outcomes = 2**k_order
+        counts = np.zeros((n_marginals, n_outcomes))
+        for start in range(0, n_marginals, chunk_size):
+            chunk_modes = modes[start : start + chunk_size]
+            n_chunk = len(chunk_modes)
+            code_type = np.int32 if n_chunk * n_outcomes < 2**31 else np.int64
+            offsets = (np.arange(n_chunk) * n_outcomes).astype(code_type)
+            block_size = max(1, max_elements // n_chunk)
+            for row_start in range(0, n_rows, block_size):
+                if isinstance(S_matrix, ClickMatrix):
+                    packed_block = S_matrix.packed[row_start : row_start + block_size]
+                    block = np.unpackbits(packed_block, axis=1, count=S_matrix.n_modes)
+                else:
+                    block = S_matrix[row_start : row_start + block_size] != 0
+                codes = np.zeros((len(block), n_chunk), dtype=code_type)
+                for b in range(k_order):
+                    codes <<= 1
+                    codes |= block[:, chunk_modes[:, b]]
+                codes += offsets
+                chunk_counts = np.bincount(codes.reshape(-1), minlength=n_chunk * n_outcomes)
+                counts[start : start + n_chunk] += chunk_counts.reshape(n_chunk, n_outcomes)
+        return counts / n_rows
+
+    def _get_empirical_marginals_from_click_lists(
         self,
-        matrix: np.ndarray,
-        bit_indices: np.ndarray, 
-        ideal_marginal: np.ndarray
+        S_matrix: SparseClickMatrix,
+        modes: np.ndarray,
+        chunk_size: int = 256
     ) -> np.ndarray:
-        """Returns the KL divergence between the ideal marginal and the
-        empirical marginal. The empirical marginal is calculated from all the
-        bitstrings up to the position specified by the bit_indices (including
-        this position)."""
-        row_index = bit_indices[0][0]
-        k_order = len(bit_indices)
-        column_inds = [bit_indices[j][1] for j in range(k_order)]
-        submatrix = matrix[0 : row_index + 1, column_inds]
-        empirical_distr = self.get_distribution_from_outcomes(submatrix)
-        return kl_divergence(ideal_marginal, empirical_distr)
-    
+        """Version of get_empirical_marginals for click lists. Every click of mode m
+        adds the bit of m to the outcome of its row in each marginal which contains
+        m, so only the (row, marginal) pairs with at least one click are encoded and
+        the rows with no clicks in a marginal are counted as its all-zero outcome.
+        The cost scales with the number of clicks instead of n_rows*n_modes."""
+        modes = np.asarray(modes)
+        n_marginals, k_order = modes.shape
+        n_outcomes = 2**k_order
+        n_rows = len(S_matrix)
+        click_rows = S_matrix.get_click_rows()
+        counts = np.empty((n_marginals, n_outcomes))
+        for start in range(0, n_marginals, chunk_size):
+            chunk_modes = modes[start : start + chunk_size]
+            n_chunk = len(chunk_modes)
+            # Positions in chunk_modes of every mode, grouped by mode
+            entries = np.argsort(chunk_modes.reshape(-1), kind='stable')
+            mode_counts = np.bincount(chunk_modes.reshape(-1), minlength=S_matrix.n_modes)
+            mode_starts = np.concatenate(([0], np.cumsum(mode_counts)[:-1]))
+            lengths = mode_counts[S_matrix.indices]
+            clicks = np.repeat(np.arange(len(S_matrix.indices)), lengths)
+            offsets = np.arange(len(clicks)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            entry = entries[mode_starts[S_matrix.indices[clicks]] + offsets]
+            marginal = entry // k_order
+            bits = 2**(k_order - 1 - entry % k_order)
+            pairs, inverse = np.unique(click_rows[clicks] * n_chunk + marginal, return_inverse=True)
+            codes = np.bincount(inverse, weights=bits, minlength=len(pairs)).astype(np.int64)
+            pair_marginals = pairs % n_chunk
+            chunk_counts = np.bincount(
+                pair_marginals * n_outcomes + codes, minlength=n_chunk * n_outcomes
+            ).reshape(n_chunk, n_outcomes).astype(float)
+            chunk_counts[:, 0] += n_rows - np.bincount(pair_marginals, minlength=n_chunk)
+            counts[start : start + n_chunk] = chunk_counts
+        return counts / n_rows
+
     def _get_optimal_bitstring_in_decimal_for_first_column(
         self,
-        S_matrix: np.ndarray,
-        bit_indices: np.ndarray, 
-        ideal_distrs: np.ndarray
+        state: GreedyState
     ) -> int:
         """Returns the optimal bitstring in decimal for the submatrix with index = 0."""
-        dists: List = []
-        for j in range(2**len(bit_indices)):
-            S_matrix_copy = copy.deepcopy(S_matrix)
-            bitstring = int_to_padded_bitstring(j, len(bit_indices))
-            for i, bit in enumerate(bitstring):
-                S_matrix_copy[bit_indices[i]] = bit
-            variation_distance = self._get_marginal_variation_dist(S_matrix_copy, bit_indices, ideal_distrs[0][1])
-            dists.append(variation_distance)
-        optimal_ind = np.argmin(dists)
-        return optimal_ind
+        dists = state.trial(state.first_column_candidates)
+        return int(np.argmin(dists))
     
-    def _get_optimal_bitstring_in_decimal_for_column(
+    def _get_optimal_bit_for_column(
         self,
-        S_matrix: np.ndarray,
-        bit_indices: np.ndarray, 
-        ideal_distrs: np.ndarray
+        candidates: np.ndarray,
+        state: GreedyState
     ) -> int:
-        """Returns the optimal bitstring in decimal for a column with index > 0."""
-        k_order = len(bit_indices)
-        fixed_bits = tuple([S_matrix[bit_indices[i]] for i in range(k_order - 1)])
-        possible_inds = [bitstring_to_int(fixed_bits + (0,)), bitstring_to_int(fixed_bits + (1,))]
-        row_index = bit_indices[0][0]
-        dists: List = []
-        for j in possible_inds:
-            S_matrix_copy = copy.deepcopy(S_matrix)
-            bitstring = int_to_padded_bitstring(j, len(bit_indices))
-            for i, bit in enumerate(bitstring):
-                S_matrix_copy[bit_indices[i]] = bit
-            variation_distance = 0.0
-            for i in range(len(ideal_distrs)):
-                column_inds = ideal_distrs[i][0]
-                marginal = ideal_distrs[i][1]
-                indices = [(row_index,) + (ind,) for ind in column_inds]
-                variation_distance += self._get_marginal_variation_dist(S_matrix_copy, indices, marginal)
-            dists.append(variation_distance)
-        optimal_ind = possible_inds[np.argmin(dists)]
-        return optimal_ind
+        """Returns the optimal value of the last bit of the submatrix for a column
+        with index > 0, given the candidate outcomes of the row being filled."""
+        dists = state.trial(candidates)
+        return int(np.argmin(dists))
     
     def _add_optimal_bitstring(
         self, 
-        S_matrix: np.ndarray,
-        bit_indices: np.ndarray, 
-        ideal_distrs: np.ndarray,
+        row: np.ndarray,
+        state: GreedyState,
         iteration_number: int
     ) -> None:
-        """ Adds the bitstring to the S_matrix which minimizes the distance
-        between the empirical and ideal distributions.Add bitstring where 
+        """ Adds the bitstring to the row of the S_matrix (a view) which minimizes
+        the distance between the empirical and ideal distributions.Add bitstring where 
         the pointwise distance between the previous empirical distribution
         and the ideal distribution is the highest (where we need to add the
-        highest amount of probability mass)."""
+        highest amount of probability mass). Candidates are only trialled on
+        the count tables of the state, so the S_matrix is never copied."""
         if iteration_number == 0:
-            optimal_ind = self._get_optimal_bitstring_in_decimal_for_first_column(S_matrix, bit_indices, ideal_distrs)
+            optimal_ind = self._get_optimal_bitstring_in_decimal_for_first_column(state)
+            row[:state.k_order] = state.first_column_bits[optimal_ind]
+            state.commit(state.first_column_candidates[optimal_ind])
         else:
-            optimal_ind = self._get_optimal_bitstring_in_decimal_for_column(S_matrix, bit_indices, ideal_distrs)
-        bitstring = int_to_padded_bitstring(optimal_ind, len(bit_indices))
-        for i, bit in enumerate(bitstring):
-            S_matrix[bit_indices[i]] = bit
+            candidates = state.get_candidates(row)
+            optimal_bit = self._get_optimal_bit_for_column(candidates, state)
+            row[iteration_number + state.k_order - 1] = optimal_bit
+            state.commit(candidates[:, optimal_bit])
+
+    def _add_optimal_bitstring_with_fixed_n_clicks(
+        self,
+        row: np.ndarray,
+        state: GreedyState,
+        iteration_number: int,
+        n_clicks: int
+    ) -> None:
+        """Same as _add_optimal_bitstring, but only allows the bitstrings with which
+        the row can still end up with exactly n_clicks clicks. Once the row has
+        n_clicks clicks the remaining bits are set to 0, and once every remaining
+        bit is needed to reach n_clicks they are set to 1."""
+        n_modes = len(row)
+        if iteration_number == 0:
+            dists = state.trial(state.first_column_candidates)
+            clicks = state.first_column_clicks
+            dists[:, (clicks > n_clicks) | (clicks + n_modes - state.k_order < n_clicks)] = np.inf
+            optimal_ind = int(np.argmin(dists))
+            row[:state.k_order] = state.first_column_bits[optimal_ind]
+            state.commit(state.first_column_candidates[optimal_ind])
+        else:
+            column = iteration_number + state.k_order - 1
+            candidates = state.get_candidates(row)
+            n_row_clicks = np.count_nonzero(row[:column])
+            if n_row_clicks == n_clicks:
+                optimal_bit = 0
+            elif n_row_clicks + n_modes - column == n_clicks:
+                optimal_bit = 1
+            else:
+                optimal_bit = self._get_optimal_bit_for_column(candidates, state)
+            row[column] = optimal_bit
+            state.commit(candidates[:, optimal_bit])
     
-    def _format_marginals(self, marginals: List, n_modes: int) -> List:
+    def _format_marginals(self, marginals: Union[MarginalTable, List], n_modes: int) -> List[MarginalTable]:
         """Format ground-truth marginals so that they can be used as inputs of the 
-        greedy algorithm. Take a list of all possible k-order combinations of mode
-        indices and reshape it such that the i-th element of the formatted marginals 
-        includes all of the marginals to be considered in the i-th iteration of the
-        greedy algorithm."""
-        k_order = len(marginals[0][0])
-        formatted_marg : List = []
-        for j in range(k_order - 1, n_modes):
-            to_join: List = []
-            for elem in marginals:
-                last_mode_index = elem[0][-1]
-                if last_mode_index == j:
-                    to_join.append(elem)
-            formatted_marg.append(to_join)
-        return formatted_marg
+        greedy algorithm. Split the table of marginals such that the i-th element of
+        the formatted marginals includes all of the marginals to be considered in the
+        i-th iteration of the greedy algorithm, i.e. those whose last mode is i+k-1."""
+        marginals = as_marginal_table(marginals)
+        return [marginals.take(marginals.get_group(j)) for j in range(marginals.k_order - 1, n_modes)]
+
+    def _format_and_check_marginals(
+        self,
+        marginals: Union[MarginalTable, List],
+        n_modes: int,
+        k_order: int
+    ) -> List[MarginalTable]:
+        """Formats the ground-truth marginals (see _format_marginals) and checks
+        that they are valid k-th order marginal distributions."""
+        marginals = as_marginal_table(marginals)
+        assert (marginals.k_order == k_order)
+        assert np.allclose(np.sum(marginals.probabilities, axis=1), 1, atol=0.05)
+        formatted_marginals = self._format_marginals(marginals, n_modes)
+        assert (len(formatted_marginals) == n_modes - k_order + 1)
+        return formatted_marginals
+
+    def _fit_S_matrix(
+        self,
+        n_modes: int,
+        n_rows: int,
+        k_order: int,
+        marginals: List[MarginalTable],
+        rng,
+        base_counts: Union[List, None] = None,
+        n_clicks: Union[int, None] = None,
+        checkpoint_path: Union[str, None] = None,
+        checkpoint_interval: int = 1000
+    ) -> np.ndarray:
+        """Runs the greedy algorithm with formatted marginals (see _format_marginals)
+        and shuffles the rows with the given random number generator (np.random or a
+        np.random.Generator). base_counts, if given, has the count tables of rows that
+        were built before for every iteration (see GreedyState). If n_clicks is given,
+        every row is built with exactly n_clicks clicks.
+
+        Instead of physically shuffling the matrix after every iteration, the rows
+        are visited in the order given by a random permutation, and the last
+        permutation is applied to the matrix once at the end.
+
+        If checkpoint_path is given, the state of the run is saved there every
+        checkpoint_interval rows (see _save_checkpoint). If the file already exists,
+        the run is resumed from it instead of starting from scratch, and the file is
+        removed once the S matrix is complete."""
+        if n_clicks is not None and not 0 <= n_clicks <= n_modes:
+            raise ValueError(f'n_clicks must be between 0 and {n_modes}')
+        S_matrix = np.empty((n_rows, n_modes), dtype=np.uint8)
+        order = np.arange(n_rows)
+        start_column, start_position, checkpoint = 0, 0, None
+        fingerprint = None if checkpoint_path is None else self._get_checkpoint_fingerprint(marginals)
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            checkpoint = self._load_checkpoint(checkpoint_path, n_modes, n_rows, k_order, n_clicks, fingerprint, rng)
+            S_matrix, order = checkpoint['S_matrix'], checkpoint['order']
+            start_column, start_position = int(checkpoint['column']), int(checkpoint['position'])
+        for j in range(start_column, n_modes - k_order + 1):
+            state = GreedyState(
+                marginals[j], base_counts=None if base_counts is None else base_counts[j], objective=self.objective)
+            first_position = 0
+            if checkpoint is not None and j == start_column:
+                state.counts[:] = checkpoint['counts']
+                state.n_rows = int(checkpoint['n_state_rows'])
+                first_position = start_position
+            for position in range(first_position, n_rows):
+                i = order[position]
+                if n_clicks is None:
+                    self._add_optimal_bitstring(S_matrix[i], state, j)
+                else:
+                    self._add_optimal_bitstring_with_fixed_n_clicks(S_matrix[i], state, j, n_clicks)
+                if checkpoint_path is not None and (position + 1) % checkpoint_interval == 0:
+                    self._save_checkpoint(
+                        checkpoint_path, S_matrix, order, j, position + 1, state, n_clicks, fingerprint, rng)
+            order = rng.permutation(n_rows)
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return S_matrix[order]
+
+    def _get_checkpoint_fingerprint(self, marginals: List[MarginalTable]) -> str:
+        """Returns a hash of the formatted marginals and of the objective (its type and
+        parameters), which identifies the targets a checkpoint was fitted to."""
+        fingerprint = hashlib.sha256()
+        for table in marginals:
+            fingerprint.update(table.modes.tobytes())
+            fingerprint.update(table.probabilities.tobytes())
+        fingerprint.update(f'{type(self.objective).__module__}.{type(self.objective).__qualname__}'.encode())
+        for name, value in sorted(vars(self.objective).items()):
+            fingerprint.update(name.encode())
+            fingerprint.update(np.asarray(value).tobytes())
+        return fingerprint.hexdigest()
+
+    def _save_checkpoint(
+        self,
+        path: str,
+        S_matrix: np.ndarray,
+        order: np.ndarray,
+        column: int,
+        position: int,
+        state: GreedyState,
+        n_clicks: Union[int, None],
+        fingerprint: str,
+        rng
+    ) -> None:
+        """Saves the partially filled S matrix, the order in which its rows are
+        visited, the iteration (column) and the number of rows already filled in it,
+        the count tables of the iteration, the fingerprint of the marginals and the
+        objective (see _get_checkpoint_fingerprint) and the state of the random number
+        generator to a .npz file (which can be loaded without pickle). The file is
+        written with write_file_atomically, so a failed save keeps the previous
+        checkpoint."""
+        write_file_atomically(path, lambda f: np.savez(
+            f,
+            S_matrix=S_matrix,
+            order=order,
+            column=column,
+            position=position,
+            counts=state.counts,
+            n_state_rows=state.n_rows,
+            n_clicks=-1 if n_clicks is None else n_clicks,
+            fingerprint=np.array(fingerprint),
+            rng_state=np.array(json.dumps(_get_rng_state(rng)))
+        ))
+
+    def _load_checkpoint(
+        self,
+        path: str,
+        n_modes: int,
+        n_rows: int,
+        k_order: int,
+        n_clicks: Union[int, None],
+        fingerprint: str,
+        rng
+    ) -> dict:
+        """Loads a checkpoint saved with _save_checkpoint, checks that it belongs to
+        a run with the same settings, marginals and objective and restores the state
+        of the random number generator."""
+        with np.load(path) as data:
+            checkpoint = {key: data[key] for key in data.files}
+        if checkpoint['S_matrix'].shape != (n_rows, n_modes):
+            raise ValueError(f'The checkpoint {path} is for an S matrix with shape {checkpoint["S_matrix"].shape}')
+        if int(checkpoint['column']) > n_modes - k_order or checkpoint['counts'].shape[-1] != 2**k_order:
+            raise ValueError(f'The checkpoint {path} is for a different order of marginals')
+        if int(checkpoint['n_clicks']) != (-1 if n_clicks is None else n_clicks):
+            raise ValueError(f'The checkpoint {path} is for a different number of clicks')
+        if 'fingerprint' not in checkpoint or str(checkpoint['fingerprint']) != fingerprint:
+            raise ValueError(f'The checkpoint {path} is for different marginals or a different objective')
+        _set_rng_state(rng, json.loads(str(checkpoint['rng_state'])))
+        return checkpoint
 
     def get_S_matrix(
         self, 
         n_modes: int, 
         n_rows: int, 
         k_order: int, 
-        marginals: np.ndarray
-    ) -> np.ndarray:
+        marginals: Union[MarginalTable, List],
+        packed: bool = False,
+        n_shards: int = 1,
+        n_workers: Union[int, None] = None,
+        n_clicks: Union[int, None] = None,
+        checkpoint_path: Union[str, None] = None,
+        checkpoint_interval: int = 1000,
+        sparse: bool = False,
+        return_distances: bool = False
+    ) -> Union[np.ndarray, ClickMatrix, SparseClickMatrix, Tuple]:
         """Takes an array of 1D discrete probability distributions
         which are the k-th order marginal distributions (e.g. of a GBS
         experiment) and approximates the full (GBS) distribution using
         Google's greedy algorithm.
 
-        i) get_submatrix indices
+        i) take the k columns of the current iteration
         ii) add optimal bitstring until all rows of submatrix are filled
-        iii) shuffle submatrix and increment iteration number
-
-        The ground truth marginals are given in an array such that the jth
-        element of that array is a list with two elements: the first is a list
-        with the corresponding mode indices of that marginal, and the second 
-        one is a list with the marginal distribution. The marginal combinations
-        are ordered as in the combinations function of itertools e.g. [0,1],
-        [0,2], [1,2].
+        iii) shuffle the rows and increment iteration number
+
+        The marginals of each iteration are tracked with running count tables
+        (see GreedyState), so every candidate bitstring is scored in constant
+        time per marginal and the cost of the algorithm is linear in n_rows.
+
+        The ground truth marginals are given as a MarginalTable with the mode
+        indices of every marginal and its distribution (a list of [modes,
+        distribution] pairs is also accepted and converted). The marginal
+        combinations are ordered as in the combinations function of itertools
+        e.g. [0,1], [0,2], [1,2].
+
+        The S matrix is built as a uint8 array of 0s and 1s. If packed is True,
+        it is returned as a bit-packed ClickMatrix instead, and if sparse is True
+        as a SparseClickMatrix of click lists (for low photon numbers); the two
+        cannot be combined. If n_shards > 1, the rows are split into shards which
+        are built in parallel processes (see get_S_matrix_sharded). To let the
+        number of rows be chosen from the marginal distances instead, see
+        get_S_matrix_adaptive, and to write a matrix which does not fit in memory
+        to disk, get_S_matrix_store.
+
+        If n_clicks is given, every row is built with exactly n_clicks clicks, so
+        that no rows are lost when only a fixed click-number sector is needed. The
+        marginals should then be those conditioned on n_clicks clicks (see
+        MarginalTable.from_distribution).
+
+        If checkpoint_path is given, the partially built matrix, the running count
+        tables and the state of np.random are saved to that file every
+        checkpoint_interval rows, and a run which finds the file resumes from it.
+        Checkpoints are only supported without sharding.
+
+        The random choices are taken from np.random, so np.random.seed makes the
+        matrix reproducible; with sharding, the seed of get_S_matrix_sharded is
+        drawn from it. If return_distances is True, the variation distances of
+        the k-th order marginals of the matrix (as in
+        get_marginal_distances_of_greedy_matrix) are returned with it.
         """
-        marginals = self._format_marginals(marginals, n_modes)
-        assert (len(marginals) == n_modes - k_order + 1)
-        for data in marginals:
-            for d in data:
-                marginal = d[1]
-                assert (len(marginal) == 2**k_order)
-                assert np.allclose(np.sum(marginal), 1, atol=0.05)
-        S_matrix = np.empty((n_rows, n_modes))
+        if packed and sparse:
+            raise ValueError('An S matrix cannot be both packed and sparse')
+        if n_shards > 1:
+            if checkpoint_path is not None:
+                raise ValueError('Checkpoints are not supported for sharded S matrices')
+            S_matrix, distances = self.get_S_matrix_sharded(
+                n_modes, n_rows, k_order, marginals, n_shards, n_workers,
+                seed=int(np.random.randint(2**31)), n_clicks=n_clicks)
+        else:
+            formatted_marginals = self._format_and_check_marginals(marginals, n_modes, k_order)
+            S_matrix = self._fit_S_matrix(
+                n_modes, n_rows, k_order, formatted_marginals, np.random, n_clicks=n_clicks,
+                checkpoint_path=checkpoint_path, checkpoint_interval=checkpoint_interval)
+            if return_distances:
+                distances = self.get_marginal_distances_of_greedy_matrix(S_matrix, k_order, marginals)
+        if packed:
+            S_matrix = ClickMatrix.from_dense(S_matrix)
+        elif sparse:
+            S_matrix = SparseClickMatrix.from_dense(S_matrix)
+        if return_distances:
+            return S_matrix, distances
+        return S_matrix
+
+    def get_S_matrix_from_sparse_marginals(
+        self,
+        n_modes: int,
+        n_rows: int,
+        marginals: List[Union[MarginalTable, List]],
+        seed: Union[int, None] = None
+    ) -> np.ndarray:
+        """Version of get_S_matrix for a sparse set of marginals, e.g. those chosen by
+        TheoreticalProbabilities.get_screened_ideal_marginals_from_torontonian, given
+        as a list of tables which may have different orders. The columns are filled
+        one mode at a time: the bit of mode m of every row is chosen to minimise the
+        sum of the changes in the objective of all the marginals (of any order) whose
+        last mode is m, so every mode needs at least one such marginal. The rows are
+        shuffled after every column, as in get_S_matrix, with a random number generator
+        built from the given seed (see get_S_matrix_ensemble)."""
+        tables = [as_marginal_table(table) for table in marginals]
+        for table in tables:
+            assert np.allclose(np.sum(table.probabilities, axis=1), 1, atol=0.05)
+        rng = np.random.default_rng(seed)
+        S_matrix = np.empty((n_rows, n_modes), dtype=np.uint8)
+        order = np.arange(n_rows)
+        for mode in range(n_modes):
+            states = [
+                GreedyState(table.take(table.get_group(mode)), objective=self.objective)
+                for table in tables if len(table.get_group(mode))
+            ]
+            if not states:
+                raise ValueError(f'No marginal has mode {mode} as its last mode')
+            for i in order:
+                row = S_matrix[i]
+                candidates = [state.get_candidates(row) for state in states]
+                dists = sum(state.trial(c) for state, c in zip(states, candidates))
+                optimal_bit = int(np.argmin(dists))
+                row[mode] = optimal_bit
+                for state, c in zip(states, candidates):
+                    state.commit(c[:, optimal_bit])
+            order = rng.permutation(n_rows)
+        return S_matrix[order]
+
+    def get_S_matrix_sharded(
+        self,
+        n_modes: int,
+        n_rows: int,
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        n_shards: int,
+        n_workers: Union[int, None] = None,
+        seed: Union[int, None] = None,
+        n_clicks: Union[int, None] = None
+    ) -> Tuple[np.ndarray, List]:
+        """Builds a single S matrix by splitting its rows into n_shards shards. Every
+        shard is fitted to the same marginals in a separate worker process (at most
+        n_workers at a time, by default one per shard up to the number of CPUs), with
+        a random number generator spawned from the given seed. The shards are then
+        concatenated and the rows shuffled once more, as after every iteration of
+        the greedy algorithm. n_clicks is used as in get_S_matrix.
+
+        Returns the merged S matrix together with the variation distances of its
+        k-th order marginals (as in get_marginal_distances_of_greedy_matrix).
+        """
+        formatted_marginals = self._format_and_check_marginals(marginals, n_modes, k_order)
+        seeds = np.random.SeedSequence(seed).spawn(n_shards + 1)
+        shard_rows = [len(x) for x in np.array_split(np.arange(n_rows), n_shards)]
+        if n_workers is None:
+            n_workers = min(n_shards, os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            shards = list(executor.map(
+                _get_S_matrix_shard,
+                [n_modes] * n_shards,
+                shard_rows,
+                [k_order] * n_shards,
+                [formatted_marginals] * n_shards,
+                seeds[:n_shards],
+                [n_clicks] * n_shards,
+                [self] * n_shards
+            ))
+        S_matrix = np.concatenate(shards)
+        np.random.default_rng(seeds[-1]).shuffle(S_matrix)
+        distances = self.get_marginal_distances_of_greedy_matrix(S_matrix, k_order, marginals)
+        return S_matrix, distances
+
+    def stream_S_matrix(
+        self,
+        n_modes: int,
+        n_rows: Union[int, None],
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        chunk_size: int,
+        seed: Union[int, None] = None,
+        n_clicks: Union[int, None] = None
+    ) -> Iterator[Tuple[np.ndarray, List]]:
+        """Generator version of get_S_matrix which yields the rows in chunks of
+        chunk_size rows, so that only one chunk is held in memory at a time. If
+        n_rows is None, chunks are yielded indefinitely.
+
+        Every chunk is built with the greedy algorithm, starting from the count
+        tables of all the rows yielded before it, so the rows of the stream fit the
+        marginals together rather than chunk by chunk. Each chunk is yielded with
+        the variation distances of the k-th order marginals of all the rows yielded
+        so far (in the format of get_marginal_distances_of_greedy_matrix).
+        n_clicks is used as in get_S_matrix.
+        """
+        marginals = as_marginal_table(marginals)
+        formatted_marginals = self._format_and_check_marginals(marginals, n_modes, k_order)
+        rng = np.random.default_rng(seed)
+        modes = marginals.modes
+        ideal = marginals.probabilities
+        group_inds = [marginals.get_group(j) for j in range(k_order - 1, n_modes)]
+        bit_weights = 2**np.arange(k_order - 1, -1, -1)
+        counts = np.zeros(ideal.shape)
+        n_streamed = 0
+        while n_rows is None or n_streamed < n_rows:
+            n_chunk = chunk_size if n_rows is None else min(chunk_size, n_rows - n_streamed)
+            base_counts = [counts[inds] for inds in group_inds] if n_streamed else None
+            chunk = self._fit_S_matrix(n_modes, n_chunk, k_order, formatted_marginals, rng, base_counts, n_clicks)
+            codes = chunk[:, modes].astype(int) @ bit_weights
+            np.add.at(counts, (np.arange(len(modes)), codes), 1)
+            n_streamed += n_chunk
+            distances = 0.5 * np.sum(np.abs(ideal - counts / n_streamed), axis=1)
+            yield chunk, [[list(m), d] for m, d in zip(modes, distances)]
+
+    def get_S_matrix_store(
+        self,
+        path: str,
+        n_modes: int,
+        n_rows: int,
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        chunk_size: int = 100000,
+        seed: Union[int, None] = None,
+        n_clicks: Union[int, None] = None
+    ) -> ClickMatrixStore:
+        """Out-of-core version of get_S_matrix. The rows are built in chunks of
+        chunk_size rows as in stream_S_matrix and written in packed form to a
+        memory-mapped ClickMatrixStore at path, so only the count tables and one
+        chunk are held in memory. Every chunk is recorded with the largest and mean
+        variation distance of the k-th order marginals of all the rows written so
+        far. The store can be passed to get_distribution_from_outcomes and to the
+        marginal distance functions, which read it one chunk at a time."""
+        store = ClickMatrixStore.create(path, n_rows, n_modes)
+        for chunk, distances in self.stream_S_matrix(n_modes, n_rows, k_order, marginals, chunk_size, seed, n_clicks):
+            distances = [d for _, d in distances]
+            store.append(chunk, max_marginal_distance=float(np.max(distances)), mean_marginal_distance=float(np.mean(distances)))
+        return store
+
+    def get_S_matrix_adaptive(
+        self,
+        n_modes: int,
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        tolerance: Union[float, None] = None,
+        plateau: Union[float, None] = None,
+        patience: int = 3,
+        block_size: int = 200,
+        max_rows: int = 100000,
+        seed: Union[int, None] = None
+    ) -> Tuple[np.ndarray, int, List]:
+        """Version of get_S_matrix which chooses the number of rows L itself. Rows are
+        added in blocks of block_size rows (see stream_S_matrix) until every marginal
+        is within a variation distance tolerance of its target, or, if plateau is
+        given, until the largest marginal distance has not gone below (1 - plateau)
+        times its lowest value so far for patience blocks in a row. No more than
+        max_rows rows are built.
+
+        Returns the S matrix, the chosen L and the error trace, which has a pair
+        [L, largest marginal distance] for every block."""
+        if tolerance is None and plateau is None:
+            raise ValueError('Either a tolerance or a plateau criterion has to be given')
+        chunks: List = []
+        trace: List = []
+        n_rows = 0
+        best_distance = np.inf
+        n_stale_blocks = 0
+        for chunk, distances in self.stream_S_matrix(n_modes, max_rows, k_order, marginals, block_size, seed):
+            chunks.append(chunk)
+            n_rows += len(chunk)
+            max_distance = float(max(d for _, d in distances))
+            trace.append([n_rows, max_distance])
+            if tolerance is not None and max_distance <= tolerance:
+                break
+            if max_distance < (1 - (plateau or 0)) * best_distance:
+                best_distance = max_distance
+                n_stale_blocks = 0
+            else:
+                n_stale_blocks += 1
+            if plateau is not None and n_stale_blocks >= patience:
+                break
+        S_matrix = np.concatenate(chunks)
+        return S_matrix, len(S_matrix), trace
+
+    def _get_extension_rows(
+        self,
+        S_matrix: np.ndarray,
+        n_new_rows: int,
+        k_order: int,
+        marginals: MarginalTable,
+        formatted_marginals: List[MarginalTable],
+        rng,
+        n_clicks: Union[int, None] = None
+    ) -> np.ndarray:
+        """Returns n_new_rows rows built with the greedy algorithm starting from the
+        count tables of the rows of S_matrix (see GreedyState)."""
+        n_modes = S_matrix.shape[1]
+        base_counts = None
+        if len(S_matrix):
+            counts = self.get_empirical_marginals(S_matrix, marginals.modes) * len(S_matrix)
+            base_counts = [counts[marginals.get_group(j)] for j in range(k_order - 1, n_modes)]
+        return self._fit_S_matrix(n_modes, n_new_rows, k_order, formatted_marginals, rng, base_counts, n_clicks)
+
+    def extend_S_matrix(
+        self,
+        S_matrix: np.ndarray,
+        n_new_rows: int,
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        seed: Union[int, None] = None,
+        n_clicks: Union[int, None] = None
+    ) -> np.ndarray:
+        """Returns the given S matrix with n_new_rows more rows appended to it. The
+        new rows are built with the greedy algorithm starting from the count tables
+        of the existing rows, as in stream_S_matrix, so the extended matrix fits the
+        same marginals as a whole. The existing rows are left unchanged."""
+        marginals = as_marginal_table(marginals)
+        n_modes = S_matrix.shape[1]
+        formatted_marginals = self._format_and_check_marginals(marginals, n_modes, k_order)
+        rng = np.random.default_rng(seed)
+        new_rows = self._get_extension_rows(S_matrix, n_new_rows, k_order, marginals, formatted_marginals, rng, n_clicks)
+        return np.concatenate((S_matrix, new_rows))
+
+    def get_S_matrix_for_sample_sizes(
+        self,
+        n_modes: int,
+        sample_sizes: List,
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        ideal_distribution: Union[np.ndarray, None] = None,
+        seed: Union[int, None] = None
+    ) -> Tuple[np.ndarray, List]:
+        """Builds a single S matrix for a sweep over the number of rows L. The matrix
+        is grown (see extend_S_matrix) to every sample size in turn, so its first L
+        rows are the greedy result for L rows and the whole sweep costs about as
+        much as a single run with the largest L.
+
+        Returns the S matrix with max(sample_sizes) rows and, for every sample size
+        L in increasing order, a list [L, marginal_distances, full_distance] with the
+        variation distances of all the marginals of the first L rows (in the order
+        of the marginals) and the variation distance between their empirical
+        distribution and ideal_distribution (None if it is not given)."""
+        marginals = as_marginal_table(marginals)
+        formatted_marginals = self._format_and_check_marginals(marginals, n_modes, k_order)
+        rng = np.random.default_rng(seed)
+        S_matrix = np.empty((0, n_modes), dtype=np.uint8)
+        results: List = []
+        for L in sorted(set(int(x) for x in sample_sizes)):
+            if L > len(S_matrix):
+                new_rows = self._get_extension_rows(
+                    S_matrix, L - len(S_matrix), k_order, marginals, formatted_marginals, rng)
+                S_matrix = np.concatenate((S_matrix, new_rows))
+            marginal_distances, _ = self.get_marginal_distances_and_divergences(S_matrix, marginals)
+            full_distance = None
+            if ideal_distribution is not None:
+                greedy_distribution = self.get_distribution_from_outcomes(S_matrix)
+                full_distance = total_variation_distance(np.asarray(ideal_distribution), greedy_distribution)
+            results.append([L, marginal_distances, full_distance])
+        return S_matrix, results
+
+    def get_S_matrix_ensemble(
+        self,
+        n_modes: int,
+        n_rows: int,
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        n_repetitions: int,
+        seed: Union[int, None] = None
+    ) -> np.ndarray:
+        """Builds n_repetitions independent S matrices (see get_S_matrix) from the
+        same marginals and returns them as an array with shape (n_repetitions,
+        n_rows, n_modes). The rows of all the matrices are filled together, with
+        the candidate bitstrings scored in one vectorised call for the whole
+        ensemble, so the cost is close to that of a single matrix.
+
+        Each matrix is shuffled with its own random number generator, spawned
+        from the given seed, instead of the global np.random state. As in
+        _fit_S_matrix, the shuffles are kept as row permutations which are only
+        applied to the matrices at the end.
+        """
+        marginals = self._format_and_check_marginals(marginals, n_modes, k_order)
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_repetitions)]
+        members = np.arange(n_repetitions)
+        S_matrices = np.empty((n_repetitions, n_rows, n_modes), dtype=np.uint8)
+        orders = np.tile(np.arange(n_rows), (n_repetitions, 1))
         for j in range(n_modes - k_order + 1):
-            submatrix_inds = self._get_submatrix_indices(S_matrix.shape, k_order, j)
+            state = GreedyState(marginals[j], n_repetitions, objective=self.objective)
             for i in range(n_rows):
-                self._add_optimal_bitstring(S_matrix, submatrix_inds[i], marginals[j], j)
-            np.random.shuffle(S_matrix)
+                row_inds = orders[:, i]
+                if j == 0:
+                    dists = state.trial(state.first_column_candidates)
+                    optimal_inds = np.argmin(dists, axis=1)
+                    S_matrices[members, row_inds, :k_order] = state.first_column_bits[optimal_inds]
+                    state.commit(state.first_column_candidates[optimal_inds])
+                else:
+                    candidates = state.get_candidates(S_matrices[members, row_inds])
+                    dists = state.trial(candidates)
+                    optimal_bits = np.argmin(dists, axis=1)
+                    S_matrices[members, row_inds, j + k_order - 1] = optimal_bits
+                    state.commit(candidates[members, optimal_bits])
+            orders = np.array([rng.permutation(n_rows) for rng in rngs])
+        return S_matrices[members.reshape(-1, 1), orders]
+
+    def refine_S_matrix(
+        self,
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix],
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        n_moves: Union[int, None] = None,
+        method: str = 'descent',
+        temperature: Union[float, None] = None,
+        seed: Union[int, None] = None
+    ) -> Union[np.ndarray, ClickMatrix, SparseClickMatrix]:
+        """Local-search pass over a finished S matrix which lowers the summed objective
+        (see objectives.py) of its k-th order marginals. Every move is either the flip of one bit
+        or the swap of the bits of one mode between two rows (which keeps the first
+        order marginals as they are), chosen at random with equal probability. The
+        change in the objective is evaluated incrementally (see LocalSearchState), so
+        a move costs O(C(n-1,k-1)).
+
+        With method 'descent' only the moves which lower the objective are kept. With
+        method 'annealing' moves which raise it by delta are also kept with probability
+        exp(-delta/T), where T is cooled geometrically from temperature (by default
+        0.5/n_rows) to a thousandth of it. n_moves defaults to 10 moves per bit of the
+        matrix. Returns a refined copy of the S matrix (of the same type)."""
+        if method not in ('descent', 'annealing'):
+            raise ValueError("method must be 'descent' or 'annealing'")
+        matrix_type = type(S_matrix)
+        packed = isinstance(S_matrix, (ClickMatrix, SparseClickMatrix))
+        S_matrix = S_matrix.to_dense() if packed else np.array(S_matrix, dtype=np.uint8)
+        marginals = as_marginal_table(marginals)
+        assert (marginals.k_order == k_order)
+        state = LocalSearchState(S_matrix, marginals, self.objective)
+        n_rows, n_modes = S_matrix.shape
+        if n_moves is None:
+            n_moves = 10 * n_rows * n_modes
+        if temperature is None:
+            temperature = 0.5 / n_rows
+        rng = np.random.default_rng(seed)
+        rows = rng.integers(n_rows, size=(n_moves, 2))
+        modes = rng.integers(n_modes, size=n_moves)
+        swaps = rng.random(n_moves) < 0.5
+        log_uniforms = np.log(rng.random(n_moves))
+        temperatures = temperature * 1e-3**(np.arange(n_moves) / max(n_moves - 1, 1))
+        for i in range(n_moves):
+            row, other_row = rows[i]
+            mode = modes[i]
+            delta = state.get_flip_delta(row, mode)
+            if swaps[i]:
+                if S_matrix[row, mode] == S_matrix[other_row, mode]:
+                    continue
+                state.flip(row, mode)
+                delta += state.get_flip_delta(other_row, mode)
+            if delta < 0 or (method == 'annealing' and log_uniforms[i] < -delta / temperatures[i]):
+                if swaps[i]:
+                    state.flip(other_row, mode)
+                else:
+                    state.flip(row, mode)
+            elif swaps[i]:
+                state.flip(row, mode)
+        if packed:
+            return matrix_type.from_dense(S_matrix)
         return S_matrix
 
+    def refit_S_matrix(
+        self,
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix],
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        tolerance: float,
+        max_moves: Union[int, None] = None,
+        check_interval: int = 100,
+        seed: Union[int, None] = None
+    ) -> Tuple[Union[np.ndarray, ClickMatrix, SparseClickMatrix], float, int]:
+        """Warm-started version of get_S_matrix for targets which are close to those an
+        existing S matrix was built for, e.g. neighbouring points of a loss or gate
+        error sweep. The matrix is repaired with bit flips (see LocalSearchState)
+        until every marginal is within a variation distance tolerance of its new
+        target. Every move looks at one of the marginals above tolerance, takes a row
+        with its most over-represented outcome and flips the bit of one of the modes
+        in which that outcome differs from the most under-represented one; the flip
+        is kept only if it lowers the summed objective of all the marginals.
+
+        The distances are checked every check_interval moves and no more than
+        max_moves moves (by default one per bit of the matrix) are tried. Returns
+        the re-fitted copy of the S matrix (of the same type), its largest marginal
+        distance and the number of moves tried."""
+        matrix_type = type(S_matrix)
+        packed = isinstance(S_matrix, (ClickMatrix, SparseClickMatrix))
+        S_matrix = S_matrix.to_dense() if packed else np.array(S_matrix, dtype=np.uint8)
+        marginals = as_marginal_table(marginals)
+        assert (marginals.k_order == k_order)
+        state = LocalSearchState(S_matrix, marginals, self.objective)
+        n_rows, n_modes = S_matrix.shape
+        if max_moves is None:
+            max_moves = n_rows * n_modes
+        rng = np.random.default_rng(seed)
+        bit_weights = 2**np.arange(k_order - 1, -1, -1)
+        n_moves = 0
+        distances = state.get_variation_distances()
+        while np.max(distances) > tolerance and n_moves < max_moves:
+            above_tolerance = np.flatnonzero(distances > tolerance)
+            for _ in range(min(check_interval, max_moves - n_moves)):
+                n_moves += 1
+                marginal = rng.choice(above_tolerance)
+                residuals = state.counts[marginal] / n_rows - state.ideal[marginal]
+                over, under = np.argmax(residuals), np.argmin(residuals)
+                row = rng.choice(np.flatnonzero(state.codes[:, marginal] == over))
+                mode = marginals.modes[marginal, rng.choice(np.flatnonzero((over ^ under) & bit_weights))]
+                if state.get_flip_delta(row, mode) < 0:
+                    state.flip(row, mode)
+            distances = state.get_variation_distances()
+        if packed:
+            S_matrix = matrix_type.from_dense(S_matrix)
+        return S_matrix, float(np.max(distances)), n_moves
+
+    def get_marginal_distances_and_divergences(
+        self,
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix, ClickMatrixStore],
+        marginals: Union[MarginalTable, List]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the variation distances and the KL divergences of the empirical
+        marginals of the S matrix with respect to all the given ideal marginals, as
+        two arrays in the order of the marginals. As in kl_divergence, outcomes with
+        zero ideal or empirical probability are left out of the KL divergence."""
+        marginals = as_marginal_table(marginals)
+        ideal = marginals.probabilities
+        empirical = self.get_empirical_marginals(S_matrix, marginals.modes)
+        distances = 0.5 * np.sum(np.abs(ideal - empirical), axis=1)
+        nonzero = (ideal != 0) & (empirical != 0)
+        ratios = np.divide(ideal, empirical, out=np.ones_like(ideal), where=nonzero)
+        divergences = np.sum(np.where(nonzero, ideal * np.log(ratios), 0), axis=1)
+        return distances, divergences
+
+    def get_marginal_objective_values(
+        self,
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix, ClickMatrixStore],
+        marginals: Union[MarginalTable, List],
+        objective: Union[Objective, None] = None
+    ) -> np.ndarray:
+        """Returns the value of the objective (that of the engine by default) between
+        every ideal marginal and the corresponding empirical marginal of the S matrix,
+        in the order of the marginals."""
+        marginals = as_marginal_table(marginals)
+        if objective is None:
+            objective = self.objective
+        empirical = self.get_empirical_marginals(S_matrix, marginals.modes)
+        return objective.get_distances(marginals.probabilities, empirical)
+
     def get_marginal_distances_of_greedy_matrix(
         self, 
-        S_matrix: np.ndarray, 
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix, ClickMatrixStore], 
         k_order: int, 
-        marginals: np.ndarray
-    ) -> np.ndarray:
+        marginals: Union[MarginalTable, List]
+    ) -> List:
         """Returns the variation distance of k-mode marginals with respect
-        to the given ideal marginals."""
-        n_modes = S_matrix.shape[1]
-        L = S_matrix.shape[0]
-        comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
-        final_row_inds = [[(L, i) for i in c] for c in comb]
-        distances = [[comb[i], self._get_marginal_variation_dist(S_matrix, final_row_inds[i], marginals[i][1])] for i in range(len(marginals))]
-        return distances
+        to the given ideal marginals (see get_marginal_distances_and_divergences)."""
+        marginals = as_marginal_table(marginals)
+        distances, _ = self.get_marginal_distances_and_divergences(S_matrix, marginals)
+        return [[modes, d] for modes, d in zip(marginals.modes.tolist(), distances)]
     
     def get_marginal_kl_divergences_of_greedy_matrix(self, 
-        S_matrix: np.ndarray, 
+        S_matrix: Union[np.ndarray, ClickMatrix, SparseClickMatrix, ClickMatrixStore], 
         k_order: int, 
-        marginals: np.ndarray
-    ) -> np.ndarray:
+        marginals: Union[MarginalTable, List]
+    ) -> List:
         """Returns the KL divergence of k-mode marginals with respect
-        to the given ideal marginals."""
-        n_modes = S_matrix.shape[1]
-        L = S_matrix.shape[0]
-        comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
-        final_row_inds = [[(L, i) for i in c] for c in comb]
-        divergences = [[comb[i], self._get_marginal_kl_divergence(S_matrix, final_row_inds[i], marginals[i][1])] for i in range(len(marginals))]
-        return divergences
+        to the given ideal marginals (see get_marginal_distances_and_divergences)."""
+        marginals = as_marginal_table(marginals)
+        _, divergences = self.get_marginal_distances_and_divergences(S_matrix, marginals)
+        return [[modes, d] for modes, d in zip(marginals.modes.tolist(), divergences)]
+
+
+class QuotaGreedy(Greedy):
+    """Alternative engine for the greedy algorithm which fills the columns of the S
+    matrix by allocating quotas of outcomes to blocks of rows, instead of choosing
+    the bits one row at a time. It has the same interface as Greedy.
+
+    In the first iteration the optimal fill is a largest-remainder allocation of
+    the rows to the 2^k outcomes of the first marginal. In later iterations the
+    rows of every marginal are grouped by the k-1 bits that are already fixed,
+    and each group should get a number of 1s proportional to the conditional
+    probability of the last bit. The rows are visited in random order in blocks
+    which shrink geometrically (a fraction block_fraction of the remaining rows,
+    but at least min_block_size rows). For every block, each row is scored with
+    the mean over the marginals of the fraction of the remaining quota of its
+    group that should be 1s, and the round(sum of scores) rows with the highest
+    scores get a 1. The quotas are updated after every block, so the last small
+    blocks correct the allocation of the earlier ones. The allocations target the
+    marginal probabilities directly, so this engine only uses its objective (the
+    total variation distance by default) in refine_S_matrix, refit_S_matrix and
+    get_marginal_objective_values."""
+
+    def __init__(
+        self,
+        block_fraction: float = 0.1,
+        min_block_size: int = 2,
+        objective: Union[Objective, None] = None
+    ):
+        super().__init__(objective)
+        self.block_fraction = block_fraction
+        self.min_block_size = min_block_size
+
+    def _get_largest_remainder_allocation(self, weights: np.ndarray, n: int) -> np.ndarray:
+        """Splits n into integers proportional to the given (non-negative) weights,
+        giving the leftover units to the largest remainders."""
+        exact = n * weights / np.sum(weights)
+        allocation = np.floor(exact).astype(int)
+        leftover = n - np.sum(allocation)
+        allocation[np.argsort(allocation - exact, kind='stable')[:leftover]] += 1
+        return allocation
+
+    def _get_blocks(self, order: np.ndarray) -> List:
+        """Splits the row order into blocks of geometrically decreasing size."""
+        blocks: List = []
+        start = 0
+        while start < len(order):
+            size = max(self.min_block_size, int(np.ceil((len(order) - start) * self.block_fraction)))
+            blocks.append(order[start : start + size])
+            start += size
+        return blocks
+
+    def _fit_S_matrix(
+        self,
+        n_modes: int,
+        n_rows: int,
+        k_order: int,
+        marginals: List[MarginalTable],
+        rng,
+        base_counts: Union[List, None] = None,
+        n_clicks: Union[int, None] = None,
+        checkpoint_path: Union[str, None] = None,
+        checkpoint_interval: int = 1000
+    ) -> np.ndarray:
+        """Builds the S matrix with quota allocations (see the class docstring) from
+        formatted marginals (see _format_marginals), with the given random number
+        generator. base_counts are used as in Greedy._fit_S_matrix, so the quotas
+        are those of all the rows, including the ones counted there. Rows with a
+        fixed number of clicks and checkpoints are only supported by Greedy."""
+        if n_clicks is not None or checkpoint_path is not None:
+            raise ValueError('n_clicks and checkpoint_path are only supported by Greedy')
+        S_matrix = np.empty((n_rows, n_modes), dtype=np.uint8)
+        n_base_rows = 0 if base_counts is None else int(round(np.sum(base_counts[0][0])))
+        n_total_rows = n_base_rows + n_rows
+        first_marginal = marginals[0].probabilities[0]
+        deficit = n_total_rows * first_marginal
+        if base_counts is not None:
+            deficit = np.maximum(deficit - base_counts[0][0], 0)
+        if np.sum(deficit) <= 0:
+            deficit = first_marginal
+        allocation = self._get_largest_remainder_allocation(deficit, n_rows)
+        codes = np.repeat(np.arange(2**k_order), allocation)
+        first_bits = np.array(get_binary_basis(k_order), dtype=np.uint8)
+        S_matrix[:, :k_order] = first_bits[codes[rng.permutation(n_rows)]]
+        prefix_weights = 2**np.arange(k_order - 2, -1, -1)
+        for j in range(1, n_modes - k_order + 1):
+            table = marginals[j]
+            n_marginals = len(table)
+            marginal_inds = np.arange(n_marginals)
+            prefixes = S_matrix[:, table.modes[:, :-1]].astype(np.int64) @ prefix_weights
+            target = n_total_rows * table.probabilities.reshape(n_marginals, -1, 2)
+            counts = np.zeros(target.shape)
+            if base_counts is not None:
+                counts += base_counts[j].reshape(target.shape)
+            for block in self._get_blocks(rng.permutation(n_rows)):
+                remaining = np.maximum(target - counts, 0)
+                remaining_rows = np.sum(remaining, axis=2)
+                ones_fraction = np.divide(
+                    remaining[:, :, 1], remaining_rows,
+                    out=np.full(remaining_rows.shape, 0.5),
+                    where=remaining_rows > 0
+                )
+                block_prefixes = prefixes[block]
+                scores = np.mean(ones_fraction[marginal_inds, block_prefixes], axis=1)
+                bits = np.zeros(len(block), dtype=np.uint8)
+                bits[np.argsort(-scores, kind='stable')[:int(round(np.sum(scores)))]] = 1
+                S_matrix[block, j + k_order - 1] = bits
+                bits = np.broadcast_to(bits.reshape(-1, 1), block_prefixes.shape)
+                np.add.at(counts, (np.broadcast_to(marginal_inds, block_prefixes.shape), block_prefixes, bits), 1)
+        return S_matrix
+
+    def get_S_matrix_ensemble(
+        self,
+        n_modes: int,
+        n_rows: int,
+        k_order: int,
+        marginals: Union[MarginalTable, List],
+        n_repetitions: int,
+        seed: Union[int, None] = None
+    ) -> np.ndarray:
+        """Builds n_repetitions independent S matrices, each with its own random
+        number generator spawned from the given seed (see Greedy.get_S_matrix_ensemble)."""
+        formatted_marginals = self._format_and_check_marginals(marginals, n_modes, k_order)
+        seeds = np.random.SeedSequence(seed).spawn(n_repetitions)
+        return np.array([
+            self._fit_S_matrix(n_modes, n_rows, k_order, formatted_marginals, np.random.default_rng(s))
+            for s in seeds
+        ])
+
+
+def _get_rng_state(rng) -> dict:
+    """Returns the state of np.random or of a np.random.Generator as a dictionary
+    which can be written as JSON."""
+    if isinstance(rng, np.random.Generator):
+        return {'generator': rng.bit_generator.state}
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return {'legacy': [name, keys.tolist(), pos, has_gauss, cached_gaussian]}
+
+
+def _set_rng_state(rng, state: dict) -> None:
+    """Restores a state returned by _get_rng_state."""
+    if 'generator' in state:
+        rng.bit_generator.state = state['generator']
+    else:
+        name, keys, pos, has_gauss, cached_gaussian = state['legacy']
+        rng.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
+
+def _get_S_matrix_shard(
+    n_modes: int,
+    n_rows: int,
+    k_order: int,
+    marginals: List[MarginalTable],
+    seed: np.random.SeedSequence,
+    n_clicks: Union[int, None] = None,
+    engine: Union[Greedy, None] = None
+) -> np.ndarray:
+    """Builds one shard of a sharded S matrix (see Greedy.get_S_matrix_sharded) with
+    the given engine (Greedy by default). Defined at module level so that it can be
+    sent to the worker processes."""
+    if engine is None:
+        engine = Greedy()
+    return engine._fit_S_matrix(
+        n_modes, n_rows, k_order, marginals, np.random.default_rng(seed), n_clicks=n_clicks)
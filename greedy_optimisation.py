@@ -1,11 +1,9 @@
 #%%
 import numpy as np
-from utils import total_variation_distance
 from gbs_simulation import GBS_simulation
 from scipy.stats import unitary_group
 from greedy import Greedy
 from gbs_probabilities import TheoreticalProbabilities
-from tqdm import tqdm
 import matplotlib.pyplot as plt 
 
 # %%
@@ -30,14 +28,9 @@ ideal_marg_tor = probs.get_all_ideal_marginals_from_torontonian(n_modes,r_k,U,2)
 #     distance = total_variation_distance(ideal_dist, greedy_dist)
 #     distances.append(distance)
 
-distances = []
-for i in tqdm(n_samples):  
-    print(i)
-    greedy_matrix = greedy.get_S_matrix(n_modes, int(i), 2, ideal_marg_tor)
-    greedy_dist = greedy.get_distribution_from_outcomes(greedy_matrix)
-    ideal_dist = gbs.get_noisy_marginal_from_simulation(n_modes, cutoff, r_k, U,list(range(n_modes)), 0)
-    distance = total_variation_distance(ideal_dist, greedy_dist)
-    distances.append(distance)
+ideal_dist = gbs.get_noisy_marginal_from_simulation(n_modes, cutoff, r_k, U,list(range(n_modes)), 0)
+greedy_matrix, results = greedy.get_S_matrix_for_sample_sizes(n_modes, [int(i) for i in n_samples], 2, ideal_marg_tor, ideal_dist)
+distances = [full_distance for _, _, full_distance in results]
 
 #%%
 
@@ -65,20 +65,14 @@ cutoff = 8
 #     mean_divs_noisy = []
 #     for k in k_order:
 #         ideal_margs = probs.get_all_ideal_marginals_from_torontonian(n_modes, squeezing_params, unitary, k)
-#         greedy_marginal_dists = Greedy().get_marginal_distances_of_greedy_matrix(S_matrix, k, ideal_margs)
-#         greedy_marginal_divs = Greedy().get_marginal_kl_divergences_of_greedy_matrix(S_matrix, k, ideal_margs)
-#         marginal_dists = [x[1] for x in greedy_marginal_dists]
-#         marginal_divs = [x[1] for x in greedy_marginal_divs]
+#         marginal_dists, marginal_divs = Greedy().get_marginal_distances_and_divergences(S_matrix, ideal_margs)
 #         mean_dist = np.sum(marginal_dists)/len(marginal_dists)
 #         mean_div = np.sum(marginal_divs)/len(marginal_divs)
 #         mean_dists_ideal.append(mean_dist)
 #         mean_divs_ideal.append(mean_div)
 
 #         noisy_margs = simul.get_all_noisy_marginals_from_gaussian_simulation_with_distinguishability(n_modes, cutoff, squeezing_params, unitary, k, s2)
-#         greedy_marginal_dists2 = Greedy().get_marginal_distances_of_greedy_matrix(S_matrix, k, noisy_margs)
-#         greedy_marginal_divs2 = Greedy().get_marginal_kl_divergences_of_greedy_matrix(S_matrix, k, noisy_margs)
-#         marginal_dists2 = [x[1] for x in greedy_marginal_dists2]
-#         marginal_divs2 = [x[1] for x in greedy_marginal_divs2]
+#         marginal_dists2, marginal_divs2 = Greedy().get_marginal_distances_and_divergences(S_matrix, noisy_margs)
 #         mean_dist2 = np.sum(marginal_dists2)/len(marginal_dists2)
 #         mean_div2 = np.sum(marginal_divs2)/len(marginal_divs2)
 #         mean_dists_noisy.append(mean_dist2)
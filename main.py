@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from gbs_probabilities import TheoreticalProbabilities
 from greedy import Greedy
+from marginal_table import MarginalTable
 from scipy.stats import unitary_group
 from gbs_simulation import GBS_simulation
 from tqdm import tqdm
@@ -12,7 +13,7 @@ import scipy as sp
 
 #%% Test greedy algorithm
 
-marginals = np.array(
+marginals = MarginalTable.from_pairs(
     [[[0,1], [0.25, 0.25, 0.25, 0.25]],
      [[0,2], [0.25, 0.25, 0.25, 0.25]],
      [[1,2], [0.25, 0.25, 0.25, 0.25]],
@@ -93,6 +94,21 @@ ideal_marg_simul = simul.get_ideal_marginal_from_gaussian_simulation(n_modes, 15
 print('Marginal from torontonian:', ideal_marg_tor)
 print('Marginal from simulation:', ideal_marg_simul)
 
+#%% Test analytic covariance matrices against Strawberry Fields:
+
+n_modes = 4
+squeezing_params = np.random.uniform(0.2, 0.8, n_modes)
+unitary = unitary_group.rvs(n_modes)
+loss = 0.3
+probs = TheoreticalProbabilities()
+cov_sf = probs.get_noisy_cov_matrix_sf(unitary, squeezing_params, loss)
+signal_modes = list(range(n_modes)) + list(range(2*n_modes, 3*n_modes))
+print('Ideal covariance matches:', np.allclose(probs.get_cov_matrix(unitary, squeezing_params), probs.get_cov_matrix_sf(unitary, squeezing_params)))
+print('Lossy covariance matches:', np.allclose(probs.get_cov_matrix(unitary, squeezing_params, loss), cov_sf[np.ix_(signal_modes, signal_modes)]))
+print('Marginals match:', np.allclose(
+    TheoreticalProbabilities().get_all_noisy_marginals_from_torontonian(n_modes, squeezing_params, unitary, 2, loss).probabilities,
+    TheoreticalProbabilities(cov_backend='sf').get_all_noisy_marginals_from_torontonian(n_modes, squeezing_params, unitary, 2, loss).probabilities))
+
 #%% Test lossy and ideal marginals in different backends:
 
 n_modes = 3
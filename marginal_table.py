@@ -0,0 +1,110 @@
+from typing import Dict, Iterator, List, Tuple, Union
+import numpy as np
+from itertools import combinations
+
+
+class MarginalTable():
+    """Set of k-th order marginal distributions. The mode indices of the marginals
+    are stored in a contiguous (M, k) int array and their distributions in an
+    (M, 2^k) float array, where the j-th outcome is the bitstring with decimal
+    representation j (the first mode being the most significant bit).
+
+    Indexing a table with an integer returns [modes, distribution], so it can be
+    used wherever the older arrays of [modes, distribution] pairs were used."""
+
+    def __init__(self, modes: np.ndarray, probabilities: np.ndarray):
+        self.modes = np.ascontiguousarray(modes, dtype=np.int64)
+        self.probabilities = np.ascontiguousarray(probabilities, dtype=float)
+        if self.modes.ndim != 2 or self.probabilities.shape != (len(self.modes), 2**self.modes.shape[1]):
+            raise ValueError('modes must have shape (M, k) and probabilities shape (M, 2^k)')
+        self._index: Dict[Tuple[int, ...], int] = {tuple(m): i for i, m in enumerate(self.modes.tolist())}
+        self._groups: Dict[int, np.ndarray] = {}
+        last_modes = self.modes[:, -1]
+        order = np.argsort(last_modes, kind='stable')
+        for last_mode in np.unique(last_modes):
+            self._groups[int(last_mode)] = order[last_modes[order] == last_mode]
+
+    @classmethod
+    def from_pairs(cls, marginals: List) -> 'MarginalTable':
+        """Builds a table from a list (or object array) of [modes, distribution] pairs."""
+        modes = np.array([list(m[0]) for m in marginals], dtype=np.int64)
+        probabilities = np.array([np.asarray(m[1], dtype=float) for m in marginals])
+        return cls(modes, probabilities)
+
+    @classmethod
+    def from_distribution(
+        cls,
+        distribution: np.ndarray,
+        k_order: int,
+        n_clicks: Union[int, None] = None
+    ) -> 'MarginalTable':
+        """Builds the table of all k-th order marginals of a full distribution over the
+        2^n_modes detection patterns. If n_clicks is given, the marginals are those of
+        the distribution conditioned on having exactly n_clicks clicks."""
+        distribution = np.asarray(distribution, dtype=float)
+        n_modes = int(np.log2(len(distribution)))
+        outcomes = np.arange(len(distribution))
+        bits = (outcomes.reshape(-1, 1) >> np.arange(n_modes - 1, -1, -1)) & 1
+        if n_clicks is not None:
+            distribution = np.where(np.sum(bits, axis=1) == n_clicks, distribution, 0)
+            if np.sum(distribution) <= 0:
+                raise ValueError(f'The distribution has no weight on outcomes with {n_clicks} clicks')
+            distribution = distribution / np.sum(distribution)
+        modes = np.array(list(combinations(range(n_modes), k_order)), dtype=np.int64)
+        n_outcomes = 2**k_order
+        codes = bits[:, modes] @ 2**np.arange(k_order - 1, -1, -1)
+        codes += np.arange(len(modes)) * n_outcomes
+        probabilities = np.bincount(
+            codes.reshape(-1),
+            weights=np.repeat(distribution, len(modes)),
+            minlength=len(modes) * n_outcomes
+        )
+        return cls(modes, probabilities.reshape(-1, n_outcomes))
+
+    @classmethod
+    def load(cls, path: str) -> 'MarginalTable':
+        """Loads a table saved with save()."""
+        with np.load(path) as data:
+            return cls(data['modes'], data['probabilities'])
+
+    def save(self, path: str) -> None:
+        """Saves the table as a single .npz file (which can be loaded without pickle)."""
+        np.savez(path, modes=self.modes, probabilities=self.probabilities)
+
+    @property
+    def k_order(self) -> int:
+        return self.modes.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.modes)
+
+    def __getitem__(self, i: int) -> List:
+        return [self.modes[i].tolist(), self.probabilities[i]]
+
+    def __iter__(self) -> Iterator[List]:
+        return (self[i] for i in range(len(self)))
+
+    def index(self, modes: Union[List, Tuple]) -> int:
+        """Returns the position in the table of the marginal of the given modes."""
+        return self._index[tuple(int(m) for m in modes)]
+
+    def get_marginal(self, modes: Union[List, Tuple]) -> np.ndarray:
+        """Returns the distribution of the marginal of the given modes."""
+        return self.probabilities[self.index(modes)]
+
+    def get_group(self, last_mode: int) -> np.ndarray:
+        """Returns the positions of the marginals whose last mode is last_mode, in
+        the order in which they appear in the table."""
+        return self._groups.get(last_mode, np.array([], dtype=np.int64))
+
+    def take(self, inds: np.ndarray) -> 'MarginalTable':
+        """Returns the table with the marginals at the given positions."""
+        return MarginalTable(self.modes[inds], self.probabilities[inds])
+
+
+def as_marginal_table(marginals: Union[MarginalTable, List]) -> MarginalTable:
+    """Returns the marginals as a MarginalTable, converting them if they are given
+    as a list (or object array) of [modes, distribution] pairs."""
+    if isinstance(marginals, MarginalTable):
+        return marginals
+    return MarginalTable.from_pairs(marginals)
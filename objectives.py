@@ -0,0 +1,102 @@
+from typing import List, Union
+import numpy as np
+from abc import ABC, abstractmethod
+
+
+class Objective(ABC):
+    """Distance between an ideal and an empirical marginal distribution which is a
+    sum over the outcomes of terms that only depend on the ideal and empirical
+    probabilities of that outcome (and on the outcome itself). Because of this, the
+    change in the distance when the count of one outcome changes only needs the
+    term of that outcome, which is how the greedy algorithm scores its candidates
+    (see GreedyState and LocalSearchState)."""
+
+    @abstractmethod
+    def get_terms(self, ideal: np.ndarray, empirical: np.ndarray, outcomes: np.ndarray) -> np.ndarray:
+        """Returns the term of every outcome (given in decimal), elementwise."""
+
+    def get_distances(self, ideal: np.ndarray, empirical: np.ndarray) -> np.ndarray:
+        """Returns the distance between the ideal and empirical distributions, which
+        are given along the last axis of the arrays."""
+        outcomes = np.arange(ideal.shape[-1])
+        return np.sum(self.get_terms(ideal, empirical, outcomes), axis=-1)
+
+    def add_count_changes(
+        self,
+        ideal: np.ndarray,
+        counts: np.ndarray,
+        outcomes: np.ndarray,
+        n_rows: int,
+        out: np.ndarray
+    ) -> None:
+        """Writes to out the change in the term of every outcome when its count goes
+        from counts to counts + 1, with n_rows rows in total. counts may be
+        overwritten."""
+        out[...] = self.get_terms(ideal, (counts + 1) / n_rows, outcomes) - self.get_terms(ideal, counts / n_rows, outcomes)
+
+
+class TotalVariationDistance(Objective):
+    """Total variation distance, 0.5*sum(|p - q|). This is the objective of the
+    original greedy algorithm."""
+
+    def get_terms(self, ideal: np.ndarray, empirical: np.ndarray, outcomes: np.ndarray) -> np.ndarray:
+        return 0.5 * np.abs(ideal - empirical)
+
+    def add_count_changes(
+        self,
+        ideal: np.ndarray,
+        counts: np.ndarray,
+        outcomes: np.ndarray,
+        n_rows: int,
+        out: np.ndarray
+    ) -> None:
+        np.add(counts, 1, out=out)
+        out /= n_rows
+        np.subtract(ideal, out, out=out)
+        np.abs(out, out=out)
+        counts /= n_rows
+        np.subtract(ideal, counts, out=counts)
+        np.abs(counts, out=counts)
+        out -= counts
+        out *= 0.5
+
+
+class WeightedTotalVariationDistance(Objective):
+    """Total variation distance in which the outcome j of every marginal (in
+    decimal) is weighted by weights[j], 0.5*sum(w*|p - q|)."""
+
+    def __init__(self, weights: Union[np.ndarray, List]):
+        self.weights = np.asarray(weights, dtype=float)
+
+    def get_terms(self, ideal: np.ndarray, empirical: np.ndarray, outcomes: np.ndarray) -> np.ndarray:
+        return 0.5 * self.weights[outcomes] * np.abs(ideal - empirical)
+
+
+class KLDivergence(Objective):
+    """Kullback-Leibler divergence of the empirical distribution from the ideal one,
+    sum(p*log(p/q)). Empirical probabilities are floored at eps, so that outcomes
+    which have not appeared yet give a large but finite term."""
+
+    def __init__(self, eps: float = 1e-12):
+        self.eps = eps
+
+    def get_terms(self, ideal: np.ndarray, empirical: np.ndarray, outcomes: np.ndarray) -> np.ndarray:
+        return ideal * (np.log(np.maximum(ideal, self.eps)) - np.log(np.maximum(empirical, self.eps)))
+
+
+class HellingerDistance(Objective):
+    """Squared Hellinger distance, 0.5*sum((sqrt(p) - sqrt(q))^2)."""
+
+    def get_terms(self, ideal: np.ndarray, empirical: np.ndarray, outcomes: np.ndarray) -> np.ndarray:
+        return 0.5 * (np.sqrt(ideal) - np.sqrt(empirical))**2
+
+
+class ChiSquaredDistance(Objective):
+    """Pearson chi-squared distance, sum((q - p)^2/p). Ideal probabilities are
+    floored at eps, so outcomes which should not appear are heavily penalised."""
+
+    def __init__(self, eps: float = 1e-12):
+        self.eps = eps
+
+    def get_terms(self, ideal: np.ndarray, empirical: np.ndarray, outcomes: np.ndarray) -> np.ndarray:
+        return (empirical - ideal)**2 / np.maximum(ideal, self.eps)
@@ -4,6 +4,7 @@ from utils import total_variation_distance
 from gbs_simulation import GBS_simulation
 from scipy.stats import unitary_group
 from greedy import Greedy
+from marginal_table import MarginalTable
 from gbs_probabilities import TheoreticalProbabilities
 from tqdm import tqdm
 import matplotlib.pyplot as plt 
@@ -23,15 +24,23 @@ cutoff = 7
 n_points = 30
 loss = np.linspace(0, 1, n_points )
 L = 1000
+tolerance = 0.01
 #%%
 
 ideal_marg_tor = probs.get_all_ideal_marginals_from_torontonian(n_modes,r_k,U,2)
-greedy_matrix = greedy.get_S_matrix(n_modes, L, 2, ideal_marg_tor)
-greedy_dist = greedy.get_distribution_from_outcomes(greedy_matrix)
-
+chunks = []
+for chunk, marginal_dists in greedy.stream_S_matrix(n_modes, L, 2, ideal_marg_tor, chunk_size=200):
+    chunks.append(chunk)
+    print('Mean marginal distance so far:', np.mean([x[1] for x in marginal_dists]))
+greedy_matrix = np.concatenate(chunks)
+
+# The greedy matrix is re-fitted to the marginals of every sweep point, starting
+# from the matrix of the previous point, instead of being built from scratch.
 distances = []
 for i in tqdm(loss):  
     ideal_dist = gbs.get_lossy_marginal_from_gaussian_simulation(n_modes, cutoff, r_k, U,list(range(n_modes)), i)
+    greedy_matrix, _, _ = greedy.refit_S_matrix(greedy_matrix, 2, MarginalTable.from_distribution(ideal_dist, 2), tolerance)
+    greedy_dist = greedy.get_distribution_from_outcomes(greedy_matrix)
     distance = total_variation_distance(ideal_dist, greedy_dist)
     distances.append(distance)
 
@@ -58,14 +67,16 @@ r_k = [0.4] * n_modes
 
 ideal_marg_tor = probs.get_all_ideal_marginals_from_torontonian(n_modes,r_k,U,2)
 greedy_matrix = greedy.get_S_matrix(n_modes, 500, 2, ideal_marg_tor)
-greedy_dist = greedy.get_distribution_from_outcomes(greedy_matrix)
 
 cutoff = 6
 stddev = np.linspace(0, 5, 10)
+tolerance = 0.01
 
 distances = []
 for i in tqdm(stddev):  
     ideal_dist = gbs.get_noisy_marginal_gate_error(cutoff, r_k, U, list(range(n_modes)), i)
+    greedy_matrix, _, _ = greedy.refit_S_matrix(greedy_matrix, 2, MarginalTable.from_distribution(ideal_dist, 2), tolerance)
+    greedy_dist = greedy.get_distribution_from_outcomes(greedy_matrix)
     distance = total_variation_distance(ideal_dist, greedy_dist)
     distances.append(distance)
 
@@ -90,7 +101,6 @@ r_k = [0.4] * n_modes
 
 ideal_marg_tor = probs.get_all_ideal_marginals_from_torontonian(n_modes,r_k,U,2)
 greedy_matrix = greedy.get_S_matrix(n_modes, 1000, 2, ideal_marg_tor)
-greedy_distr = greedy.get_distribution_from_outcomes(greedy_matrix)
 
 #%%
 cutoff = 6
@@ -98,6 +108,7 @@ range_n = 0.3
 n_points = 30
 stddev = np.linspace(0, range_n, n_points)
 repetitions = 100
+tolerance = 0.01
 #%%
 distances = []
 for i in tqdm(stddev):  
@@ -109,6 +120,8 @@ for i in tqdm(stddev):
         # print(f'initial_ideal_distr= {initial_ideal_distr}')
     avg_ideal_distr = initial_ideal_distr/repetitions
     # print(avg_ideal_distr)
+    greedy_matrix, _, _ = greedy.refit_S_matrix(greedy_matrix, 2, MarginalTable.from_distribution(avg_ideal_distr, 2), tolerance)
+    greedy_distr = greedy.get_distribution_from_outcomes(greedy_matrix)
     distance = total_variation_distance(avg_ideal_distr, greedy_distr)
     distances.append(distance)
 
@@ -73,7 +73,7 @@ distances = []
 for i in tqdm(loss):
     squeezing = [get_scaled_squeezing(mean_n_photon, n_modes, i)]*n_modes
     marginals = gbs.get_all_lossy_marginals_from_gaussian_simulation(n_modes, cutoff, squeezing, U, 2, i)
-    greedy_matrix = greedy.get_S_matrix(n_modes, L, 2, marginals)
+    greedy_matrix = greedy.get_S_matrix(n_modes, L, 2, marginals, sparse=True)
     greedy_distr = greedy.get_distribution_from_outcomes(greedy_matrix)
     print('Total mean photon number:', total_mean_photon_number(i, n_modes, squeezing[0]))
     ground_distr = gbs.get_lossy_marginal_from_gaussian_simulation(n_modes, cutoff, squeezing, U,list(range(n_modes)), i)
@@ -1,5 +1,4 @@
 #%%
-from collections import Counter
 import numpy as np
 from utils import total_variation_distance, kl_divergence
 from gbs_simulation import GBS_simulation
@@ -8,7 +7,7 @@ from greedy import Greedy
 from gbs_probabilities import TheoreticalProbabilities
 from tqdm import tqdm
 import matplotlib.pyplot as plt
-from utils import bitstring_to_int
+from click_matrix import ClickMatrix
 
 n_modes = 4
 s = 0.5
@@ -24,30 +23,15 @@ greedy = Greedy()
 
 probs = TheoreticalProbabilities()
 
-def get_submatrix_with_fixed_n_clicks(
-    S_matrix: np.ndarray,
-    n: int
-) -> np.ndarray:
-    submatrix = []
-    for elem in S_matrix:
-        count = np.count_nonzero(elem == 1.0)
-        if count == n:
-            submatrix.append(elem)
-    return np.array(submatrix)
+def get_distribution_from_outcomes(samples: ClickMatrix) -> np.ndarray:
+    """Turns packed outcomes (bitstrings) into the empirical distribution over
+    the outcomes that appear at least once."""
+    subset, counts = np.unique(samples.get_row_codes(), return_counts=True)
+    distribution = counts / np.sum(counts)
+    return [int(x) for x in subset], distribution
 
-def get_distribution_from_outcomes(samples: np.ndarray) -> np.ndarray:
-    """Turns list of outcomes (bitstrings) into empirical distribution."""
-    bitstrings = [tuple(x) for x in samples]
-    sorted_decimal_list = np.sort([bitstring_to_int(binary) for binary in bitstrings])
-    count_dict = Counter(sorted_decimal_list)
-    counts = [count_dict.get(i, 0) for i in range(2**len(samples[0]))]
-    counts = [x for x in counts if x!= 0]
-    distribution = np.array(counts) / np.sum(counts)
-    return list(count_dict.keys()), distribution
-
-ideal_marg_tor = probs.get_all_ideal_marginals_from_torontonian(n_modes,r_k,U,2)
-greedy_matrix = greedy.get_S_matrix(n_modes, L, 2, ideal_marg_tor)
-fixed_n_clicks_submatrix = get_submatrix_with_fixed_n_clicks(greedy_matrix, n_fixed)
+conditional_marg_tor = probs.get_all_ideal_marginals_with_fixed_n_clicks_from_torontonian(n_modes,r_k,U,2,n_fixed)
+fixed_n_clicks_submatrix = greedy.get_S_matrix(n_modes, L, 2, conditional_marg_tor, packed=True, n_clicks=n_fixed)
 subset, greedy_distr = get_distribution_from_outcomes(fixed_n_clicks_submatrix)
 print('Bitstring subset (in decimal):', subset)
 
@@ -88,11 +72,11 @@ plt.show()
 # n_fixed = np.arange(0, n_modes + 1, 1)
 
 # ideal_marg_tor = probs.get_all_ideal_marginals_from_torontonian(n_modes,r_k,U,2)
-# greedy_matrix = greedy.get_S_matrix(n_modes, 1000, 2, ideal_marg_tor)
+# greedy_matrix = greedy.get_S_matrix(n_modes, 1000, 2, ideal_marg_tor, packed=True)
 
 # distances = []
 # for n in tqdm(n_fixed):
-#     fixed_n_clicks_submatrix = get_submatrix_with_fixed_n_clicks(greedy_matrix, n)
+#     fixed_n_clicks_submatrix = greedy_matrix.get_rows_with_n_clicks(n)
 #     subset, greedy_distr = get_distribution_from_outcomes(fixed_n_clicks_submatrix)
 #     ideal_distr = gbs.get_ideal_marginal_from_gaussian_simulation(n_modes, cutoff, r_k, U, list(range(n_modes)))
 #     conditional_probs = [x for i, x in enumerate(ideal_distr) if i in subset]
@@ -12,6 +12,7 @@ from tqdm import tqdm
 from utils import bitstring_to_int, convert_to_clicks
 import itertools as iter
 from itertools import combinations
+from marginal_table import MarginalTable
 
 plt.rcParams['axes.facecolor']='white'
 plt.rcParams['savefig.facecolor']='white'
@@ -160,14 +161,14 @@ def get_all_ideal_marginals_from_statevec(
     n_modes: int,
     ket: np.ndarray,
     k_order: int
-) -> np.ndarray:
+) -> MarginalTable:
     """Returns all kth-order marginal distributions (calculated from the state vector)."""
     comb = [list(c) for c in combinations(list(range(n_modes)), k_order)]
     marginals : List = []
     for modes in comb:
         marg = get_threshold_marginal_from_statevec(ket, modes)
         marginals.append([modes, marg])
-    return np.array(marginals)
+    return MarginalTable.from_pairs(marginals)
 
 def get_renema_output_statevec(n_modes, unitary, cutoff):
     """Superposes the output state vectors of the two disjunct Renema circuits and returns the
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from greedy import Greedy
+from marginal_table import MarginalTable
+
+
+class InterruptedRun(Exception):
+    pass
+
+
+def get_random_marginals(n_modes: int, k_order: int, seed: int) -> MarginalTable:
+    """Returns the k-th order marginals of a random distribution over n_modes modes."""
+    distribution = np.random.default_rng(seed).random(2**n_modes)**3
+    return MarginalTable.from_distribution(distribution / np.sum(distribution), k_order)
+
+
+def interrupt_after_first_checkpoint(monkeypatch):
+    """Makes the next greedy run stop right after saving its first checkpoint."""
+    save_checkpoint = Greedy._save_checkpoint
+
+    def save_and_stop(self, *args):
+        save_checkpoint(self, *args)
+        raise InterruptedRun
+
+    monkeypatch.setattr(Greedy, '_save_checkpoint', save_and_stop)
+
+
+def test_resumed_run_matches_uninterrupted_run(tmp_path, monkeypatch):
+    marginals = get_random_marginals(6, 2, seed=0)
+    checkpoint_path = str(tmp_path / 'checkpoint.npz')
+    np.random.seed(3)
+    expected = Greedy().get_S_matrix(6, 500, 2, marginals)
+    np.random.seed(3)
+    with monkeypatch.context() as patch:
+        interrupt_after_first_checkpoint(patch)
+        with pytest.raises(InterruptedRun):
+            Greedy().get_S_matrix(6, 500, 2, marginals, checkpoint_path=checkpoint_path, checkpoint_interval=100)
+    resumed = Greedy().get_S_matrix(6, 500, 2, marginals, checkpoint_path=checkpoint_path, checkpoint_interval=100)
+    assert np.array_equal(resumed, expected)
+
+
+def test_resume_against_different_marginals_raises(tmp_path, monkeypatch):
+    marginals_a = get_random_marginals(6, 2, seed=0)
+    marginals_b = get_random_marginals(6, 2, seed=1)
+    checkpoint_path = str(tmp_path / 'checkpoint.npz')
+    with monkeypatch.context() as patch:
+        interrupt_after_first_checkpoint(patch)
+        with pytest.raises(InterruptedRun):
+            Greedy().get_S_matrix(6, 500, 2, marginals_a, checkpoint_path=checkpoint_path, checkpoint_interval=100)
+    with pytest.raises(ValueError, match='different marginals'):
+        Greedy().get_S_matrix(6, 500, 2, marginals_b, checkpoint_path=checkpoint_path, checkpoint_interval=100)
@@ -1,5 +1,6 @@
-from typing import List, Tuple
+from typing import Callable, IO, List, Tuple
 import numpy as np
+import os
 from cmath import polar
 
 def int_to_bitstring(integer: int) -> Tuple[int, ...]:
@@ -18,9 +19,20 @@ def bitstring_to_int(bitstring: Tuple[int, ...]) -> int:
     """Converts a bitstring into an integer."""
     suma = 0
     for i, bit in enumerate(bitstring):
-        suma += bit*2**(len(bitstring) - i - 1)
+        suma += int(bit)*2**(len(bitstring) - i - 1)
     return int(suma)
 
+def write_file_atomically(path: str, write_contents: Callable[[IO], None], mode: str = 'wb') -> None:
+    """Writes a file with write_contents, which is given the open file. The file is
+    first written and synced next to path (path + '.tmp') and then renamed to path,
+    so a run that is killed while writing leaves the previous file intact."""
+    temp_path = path + '.tmp'
+    with open(temp_path, mode) as f:
+        write_contents(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
 def get_click_indices(bitstring: Tuple) -> List:
     """Returns indices of the 1s in a bitstring."""
     return [i for i, bit in enumerate(bitstring) if bit != 0]